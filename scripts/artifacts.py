@@ -0,0 +1,328 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Background collection of build artifacts (waveforms, emu, verilog)
+#
+# collect() only hardlinks the files into a staging directory next to them, so later
+# runs can replace or delete the originals, and returns. A hardlink does not protect a
+# file rewritten in place: verilog is truncated and rewritten by the next build, so it is
+# staged by a copy. emu is replaced by the linker and every run writes a new waveform.
+# A detached process then moves every file to the destination (hardlink, reflink or copy,
+# whichever works first) and compresses waveforms with a multi-threaded compressor on
+# the way. Every collection has its own <destination>/manifest-<id>.json, kept up to date,
+# and <destination>/.collecting-<id>, locked until it finishes and removed then, so
+# collections of other hosts can share the destination and the results can be awaited
+# after the caller exits. Files are collected as <destination>/<id>-<name>, so files of
+# the same name in different collections do not overwrite each other.
+#
+#   python3 artifacts.py $WAVE_HOME build/*.vcd build/emu   # collect in the background
+#   python3 artifacts.py $WAVE_HOME --wait                  # wait for collections of this host
+
+import argparse
+import fcntl
+import fnmatch
+import glob
+import gzip
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+MANIFEST_PREFIX = "manifest-"
+LOCK_PREFIX = ".collecting-"
+# Linux ioctl to share the extents of a file on btrfs/xfs
+FICLONE = 0x40049409
+
+# (tool, suffix, arguments to compress <src> to stdout), tried in this order
+COMPRESSORS = [
+    ("zstd", ".zst", ["-q", "-T0", "-c"]),
+    ("pigz", ".gz", ["-c"]),
+    ("xz", ".xz", ["-T0", "-1", "-c"])
+]
+
+
+def link_or_copy(src, dst):
+    """Place src at dst as cheaply as possible
+
+    Returns:
+        str: "hardlink", "reflink" or "copy"
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # renaming a hardlink over another link of the same file does nothing
+        return "hardlink"
+    tmp = f"{dst}.tmp{os.getpid()}"
+    try:
+        os.link(src, tmp)
+        method = "hardlink"
+    except OSError:
+        try:
+            with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, tmp)
+            method = "reflink"
+        except OSError:
+            shutil.copy2(src, tmp)
+            method = "copy"
+    os.replace(tmp, dst)
+    return method
+
+
+def compress(src, dst_prefix):
+    """Compress src to dst_prefix + suffix of the first available compressor
+
+    Returns:
+        (method, compressed file)
+    """
+    for tool, suffix, tool_args in COMPRESSORS:
+        if shutil.which(tool) is None:
+            continue
+        dst = dst_prefix + suffix
+        with open(f"{dst}.tmp", "wb") as f:
+            subprocess.run([tool] + tool_args + [src], stdout=f, check=True)
+        os.replace(f"{dst}.tmp", dst)
+        return tool, dst
+    # single-threaded fallback
+    dst = dst_prefix + ".gz"
+    with open(src, "rb") as fsrc, gzip.open(f"{dst}.tmp", "wb", compresslevel=1) as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    os.replace(f"{dst}.tmp", dst)
+    return "gzip", dst
+
+
+def get_manifest_path(dest, collection):
+    return os.path.join(dest, f"{MANIFEST_PREFIX}{collection}.json")
+
+
+def get_collections(dest, host=None):
+    """Ids of the collections in dest, oldest first, only the ones started on host if given"""
+    collections = []
+    for path in sorted(glob.glob(os.path.join(dest, f"{MANIFEST_PREFIX}*.json")), key=os.path.getmtime):
+        collection = os.path.basename(path)[len(MANIFEST_PREFIX):-len(".json")]
+        if host is None or read_manifest(dest, collection)["host"] == host:
+            collections.append(collection)
+    return collections
+
+
+def read_manifest(dest, collection):
+    with open(get_manifest_path(dest, collection)) as f:
+        return json.load(f)
+
+
+def write_manifest(dest, collection, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=dest, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, get_manifest_path(dest, collection))
+
+
+class ArtifactCollector(object):
+    def __init__(self, dest, staging_dir, compress_patterns=("*.vcd",), copy_patterns=("*.v", "*.sv")):
+        """
+        Args:
+            dest (str): destination directory, e.g. $WAVE_HOME
+            staging_dir (str): directory on the file system of the artifacts
+            compress_patterns (tuple): file names to compress
+            copy_patterns (tuple): file names to stage by a copy, they are rewritten in place
+        """
+        self.dest = os.path.realpath(dest)
+        self.staging_dir = staging_dir
+        self.compress_patterns = compress_patterns
+        self.copy_patterns = copy_patterns
+        self.collection = None
+
+    def __stage(self, src, staging, name):
+        """Hardlink or copy src into staging, so it is not changed by later runs, or None if that fails"""
+        staged = os.path.join(staging, name)
+        try:
+            if any(fnmatch.fnmatch(os.path.basename(src), p) for p in self.copy_patterns):
+                shutil.copy2(src, staged)
+            else:
+                os.link(src, staged)
+        except OSError:
+            return None
+        return staged
+
+    def collect(self, files, background=True, names=None):
+        """Start collecting files into the destination
+
+        Args:
+            files (list): paths of the artifacts, missing ones are skipped
+            background (bool): finish in a detached process, otherwise in this one
+            names (list): names of the files in the collection, unique, their base names by default
+
+        Returns:
+            dict: the manifest, entries are "pending" until finished
+        """
+        os.makedirs(self.dest, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.staging_dir, prefix=time.strftime("%Y%m%d-%H%M%S-"))
+        # unique among the hosts sharing dest, as the staging directory is on this host
+        self.collection = f"{socket.gethostname()}-{os.path.basename(staging)}"
+        if names is None:
+            names = [os.path.basename(src) for src in files]
+        if len(set(names)) != len(names):
+            raise ValueError(f"artifact names are not unique: {names}")
+        artifacts = []
+        for src, name in zip(files, names):
+            if not os.path.isfile(src):
+                continue
+            staged = self.__stage(src, staging, name)
+            if staged is None:
+                # a file system without hardlinks, collect it synchronously instead
+                method = link_or_copy(src, os.path.join(self.dest, f"{self.collection}-{name}"))
+                artifacts.append({"name": name, "source": src, "size": os.path.getsize(src),
+                                  "staged": None, "file": f"{self.collection}-{name}", "method": method, "status": "done"})
+                continue
+            artifacts.append({
+                "name": name,
+                "source": src,
+                "size": os.path.getsize(src),
+                "staged": staged,
+                "compress": any(fnmatch.fnmatch(name, p) for p in self.compress_patterns),
+                "status": "pending"
+            })
+        manifest = {
+            "host": socket.gethostname(),
+            "created": time.time(),
+            "finished": None,
+            "staging": staging,
+            "artifacts": artifacts
+        }
+        write_manifest(self.dest, self.collection, manifest)
+        if not background:
+            return finish(self.dest, self.collection)
+        with open(os.path.join(self.dest, "collect.log"), "a") as log:
+            subprocess.Popen([sys.executable, os.path.realpath(__file__), self.dest, "--finish", self.collection],
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        return manifest
+
+    def wait(self):
+        return wait(self.dest, self.collection)
+
+
+def finish(dest, collection, jobs=4):
+    """Move staged artifacts of a collection to dest and compress them, updating its manifest after each one"""
+    lock_path = os.path.join(dest, LOCK_PREFIX + collection)
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(dest, collection)
+
+        def finish_one(artifact):
+            # only the calling thread changes the manifest, it is dumped while others run
+            result, start = {}, time.time()
+            output = os.path.join(dest, f"{collection}-{artifact['name']}")
+            try:
+                if artifact["compress"]:
+                    result["method"], compressed = compress(artifact["staged"], output)
+                    result["file"] = os.path.basename(compressed)
+                    result["compressed_size"] = os.path.getsize(compressed)
+                else:
+                    result["method"] = link_or_copy(artifact["staged"], output)
+                    result["file"] = os.path.basename(output)
+                result["status"] = "done"
+                os.remove(artifact["staged"])
+            except (OSError, subprocess.CalledProcessError) as e:
+                # the staged file is kept for a manual retry
+                result["status"] = "failed"
+                result["error"] = str(e)
+            result["time"] = time.time() - start
+            return result
+
+        pending = [a for a in manifest["artifacts"] if a["status"] == "pending"]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(finish_one, artifact): artifact for artifact in pending}
+            for future in as_completed(futures):
+                artifact = futures[future]
+                artifact.update(future.result())
+                print(f"{artifact['status']} {artifact['name']} in {artifact['time']:.1f}s", flush=True)
+                write_manifest(dest, collection, manifest)
+        manifest["finished"] = time.time()
+        write_manifest(dest, collection, manifest)
+        try:
+            os.rmdir(manifest["staging"])
+        except OSError:
+            pass
+        # waiters that opened it still get the lock, later ones see the finished manifest
+        os.remove(lock_path)
+    return manifest
+
+
+def wait(dest, collection, start_timeout=60):
+    """Wait until a collection into dest has finished, and get its manifest
+
+    Args:
+        start_timeout (float): seconds to wait for the detached process to take the lock
+    """
+    start = time.time()
+    while True:
+        manifest = read_manifest(dest, collection)
+        if manifest["finished"] is not None:
+            return manifest
+        try:
+            # without O_CREAT, so a removed lock file is not left behind again
+            # O_RDWR as an exclusive lock on NFS needs write access
+            fd = os.open(os.path.join(dest, LOCK_PREFIX + collection), os.O_RDWR)
+        except FileNotFoundError:
+            # finished, or the detached process has not started yet
+            fd = None
+        if fd is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            finally:
+                os.close(fd)
+        manifest = read_manifest(dest, collection)
+        if manifest["finished"] is not None or all(a["status"] != "pending" for a in manifest["artifacts"]):
+            return manifest
+        if time.time() - start > start_timeout:
+            print(f"[WARNING] artifacts of {collection} in {dest} are pending, but nothing is collecting them")
+            return manifest
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="collect build artifacts in the background")
+    parser.add_argument("dest", type=str, help="destination directory")
+    parser.add_argument("files", nargs="*", type=str, help="artifacts to collect")
+    parser.add_argument("--staging", type=str, help="staging directory (default: .artifacts next to the first file)")
+    parser.add_argument("--wait", action="store_true", help="wait until the collections started on this host have finished")
+    parser.add_argument("--finish", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.finish is not None:
+        finish(args.dest, args.finish)
+        sys.exit(0)
+    if args.files:
+        staging = args.staging or os.path.join(os.path.dirname(os.path.abspath(args.files[0])), ".artifacts")
+        collector = ArtifactCollector(args.dest, staging)
+        collector.collect(args.files, background=not args.wait)
+        collections = [collector.collection]
+    else:
+        collections = get_collections(args.dest, socket.gethostname() if args.wait else None)
+    failed = False
+    for collection in collections:
+        manifest = wait(args.dest, collection) if args.wait else read_manifest(args.dest, collection)
+        print(f"{collection}:")
+        for a in manifest["artifacts"]:
+            print(f"    {a['status']:<8} {a.get('method', ''):<8} {a['size']:>14} {a.get('file') or a['name']}")
+        failed = failed or any(a["status"] == "failed" for a in manifest["artifacts"])
+    sys.exit(1 if failed else 0)
@@ -17,13 +17,14 @@
 
 import sh
 import os
-import re
 import os.path as osp
 import sys, getopt
 from pprint import pprint
 import multiprocessing
 from multiprocessing import Pool, Lock, Manager, Process
 
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), ".."))
+from checkpoints import load_checkpoints
 from common.simulator_task_goback import SimulatorTaskGoBack
 from common.task_tree_go_back import task_tree_to_batch_task
 from config import EmuTasksConfig
@@ -53,23 +54,9 @@ THREADS_NUM = 8 # 每个 `emu` 任务运行时将会所占的 `cpu` 核数，一
 MAX_CORE = 128 # 所有 `emu` 任务占用的最大 `cpu` 核数，因此可以同时运行 `MAX_CORE / THREADS_NUM` 个 `emu` 任务
 MAX_INSTR = 1000000 # 每个 `emu` 任务运行的最大指令数
 
-cpt_dir_pattern = re.compile(r'\d+')
-
 def find_task(d: str):
-    for workload in os.listdir(d):
-        workload_dir = osp.join(d, workload)
-        if not osp.isdir(workload_dir):
-            continue
-        TaskSummary[workload] = {}
-        for cpt in os.listdir(workload_dir):
-            cpt_dir = osp.join(workload_dir, cpt)
-            if not cpt_dir_pattern.match(cpt) or not osp.isdir(cpt_dir):
-                continue
-            cpt_file = os.listdir(cpt_dir)[0]
-            cpt_file = osp.join(cpt_dir, cpt_file)
-            assert osp.isfile(cpt_file)
-
-            TaskSummary[workload][cpt] = cpt_file
+    for checkpoint in load_checkpoints(d):
+        TaskSummary.setdefault(checkpoint["benchmark"], {})[checkpoint["point"]] = checkpoint["path"]
     return TaskSummary
 
 def task_wrapper(task: SimulatorTaskGoBack, thread_num: int, cores_id: int, cores):
@@ -0,0 +1,249 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Content-addressed cache of build outputs
+#
+# The key of a build is the hash of all sources (Scala of XiangShan and its submodules,
+# difftest, build scripts, DRAMsim3 when built with it), the versions of the build tools
+# and the make target with its arguments. Outputs of a successful build are copied to
+# <cache dir>/<key>, and restored into $NOOP_HOME/build instead of running make when
+# the same key is built again.
+#
+# The Makefile rewrites two sources before every build: bootrom_disable in SimTop.scala
+# (from ROT) and the absolute ROT vmem path in rot_top.sv. These lines are hashed without
+# their value, and ROT and the vmem path, which the outputs embed, are part of the key
+# instead. So a build is only restored into a checkout at the same path.
+#
+#   python3 build_cache.py --list
+#   python3 build_cache.py --clean
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+
+DEFAULT_CACHE_DIR = os.getenv("XS_BUILD_CACHE", os.path.expanduser("~/.cache/xiangshan/build"))
+
+# everything read by mill, postcompile and the difftest makefiles
+SOURCES = [
+    "build.sc", "Makefile", "src", "scripts/postcompile",
+    "rocket-chip", "difftest", "huancun", "fudian", "xs-utils", "coupledL2"
+]
+SKIP_DIRS = {".git", "build", "out", "__pycache__", ".bsp", ".idea", "node_modules"}
+# sources rewritten by the Makefile -> pattern of the rewritten value, replaced by its group 1
+REWRITTEN_SOURCES = {
+    "src/test/scala/top/SimTop.scala": re.compile(rb'(soc\.bootrom_disable\s*:=\s*).*\.B'),
+    "src/main/resources/TLROT/src/lowrisc_systems_rot_top_0.1/rtl/rot_top.sv":
+        re.compile(rb'(parameter RomCtrlBootRomInitFile = )".*"')
+}
+# ROT_VMEM_DIR of the Makefile, relative to $(CURDIR)
+ROT_VMEM = "src/main/resources/TLROT/test.vmem"
+# tools whose version changes the outputs
+TOOLS = ["verilator", "mill", "gcc", "g++"]
+
+# build outputs of every make target, glob patterns relative to $NOOP_HOME
+OUTPUTS = {
+    "verilog": ["build/rtl"],
+    "sim-verilog": ["build/*.sv", "build/*.v", "build/cpu_flist.f"],
+    "emu": ["build/*.sv", "build/*.v", "build/cpu_flist.f", "build/emu"]
+}
+
+
+def get_source_hash(noop_home, sources=SOURCES):
+    """sha256 of the relative path, mode and content of every source file"""
+    digest = hashlib.sha256()
+    for source in sources:
+        path = os.path.join(noop_home, source)
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = []
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+                files += [os.path.join(root, name) for name in sorted(names)]
+        for file in files:
+            if not os.path.isfile(file):
+                continue
+            relpath = os.path.relpath(file, noop_home)
+            digest.update(relpath.encode() + b"\0")
+            digest.update(str(os.stat(file).st_mode & 0o111).encode() + b"\0")
+            with open(file, "rb") as f:
+                if relpath in REWRITTEN_SOURCES:
+                    digest.update(REWRITTEN_SOURCES[relpath].sub(rb"\1", f.read()))
+                    continue
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def get_tool_versions(tools=TOOLS):
+    """tool -> output of tool --version, None if it is not installed"""
+    versions = {}
+    for tool in tools:
+        try:
+            output = subprocess.check_output([tool, "--version"], stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            versions[tool] = output.decode(errors="replace").strip()
+        except (OSError, subprocess.CalledProcessError):
+            versions[tool] = None
+    return versions
+
+
+class BuildCache(object):
+    def __init__(self, noop_home, cache_dir=DEFAULT_CACHE_DIR, max_entries=8, dramsim3_home=None):
+        self.noop_home = noop_home
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.dramsim3_home = dramsim3_home
+        self.source_hash = None
+        self.dramsim3_hash = None
+        self.tool_versions = None
+
+    def get_key(self, target, make_args, sim_args):
+        """Key of a make target
+
+        Args:
+            target (str): make target in OUTPUTS
+            make_args (list): (value, name) of makefile arguments
+            sim_args (list): chisel arguments
+        """
+        if self.source_hash is None:
+            self.source_hash = get_source_hash(self.noop_home)
+            self.tool_versions = get_tool_versions()
+        make_args = list(make_args)
+        dramsim3 = any(name == "WITH_DRAMSIM3" for _, name in make_args)
+        if dramsim3 and self.dramsim3_hash is None and self.dramsim3_home is not None:
+            self.dramsim3_hash = get_source_hash(self.dramsim3_home, [""])
+        config = {
+            "sources": self.source_hash,
+            "dramsim3": self.dramsim3_hash if dramsim3 else None,
+            "tools": self.tool_versions,
+            # what the Makefile writes into the rewritten sources
+            "rot": os.getenv("ROT"),
+            "rot_vmem_dir": os.path.join(os.path.realpath(self.noop_home), ROT_VMEM),
+            "target": target,
+            "make_args": sorted(f"{name}={value}" for value, name in make_args),
+            "sim_args": sorted(sim_args)
+        }
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:32]
+
+    def get_outputs(self, target):
+        """Existing output files and directories of a target, relative to $NOOP_HOME"""
+        outputs = []
+        for pattern in OUTPUTS[target]:
+            outputs += sorted(glob.glob(os.path.join(self.noop_home, pattern)))
+        return [os.path.relpath(path, self.noop_home) for path in outputs]
+
+    def restore(self, key, target):
+        """Copy cached outputs into $NOOP_HOME, False if the key is not cached"""
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        # outputs of an earlier build, e.g. rtl files of another configuration, would be left over
+        for output in self.get_outputs(target):
+            path = os.path.join(self.noop_home, output)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        for output in manifest["outputs"]:
+            src, dst = os.path.join(entry, output), os.path.join(self.noop_home, output)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            else:
+                shutil.copy2(src, dst)
+                # make compares mtimes, restored outputs are newer than the sources
+                os.utime(dst)
+        # least recently used entries are evicted first
+        os.utime(entry)
+        print(f"Restored {target} from build cache {entry}")
+        return True
+
+    def store(self, key, target):
+        """Copy outputs of a successful build into the cache, skipped if any output is missing"""
+        outputs = self.get_outputs(target)
+        expected = [p for p in OUTPUTS[target] if not glob.has_magic(p)]
+        if not outputs or any(p not in outputs for p in expected):
+            print(f"[WARNING] {target} outputs are missing, not saved to build cache")
+            return False
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return True
+        # copy to a temporary directory and rename, so other builds never restore a partial entry
+        tmp_entry = f"{entry}.tmp{os.getpid()}"
+        try:
+            for output in outputs:
+                src, dst = os.path.join(self.noop_home, output), os.path.join(tmp_entry, output)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as f:
+                json.dump({"target": target, "outputs": outputs, "time": time.time()}, f)
+            os.rename(tmp_entry, entry)
+        except OSError as e:
+            print(f"[WARNING] {target} is not saved to build cache: {e}")
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return False
+        print(f"Saved {target} to build cache {entry}")
+        self.evict()
+        return True
+
+    def get_entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isfile(os.path.join(path, "manifest.json")):
+                entries.append(path)
+        return sorted(entries, key=os.path.getmtime, reverse=True)
+
+    def evict(self):
+        for entry in self.get_entries()[self.max_entries:]:
+            print(f"Evict build cache {entry}")
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="content-addressed cache of XiangShan build outputs")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR, help="cache directory")
+    parser.add_argument("--list", action="store_true", help="list cached builds")
+    parser.add_argument("--clean", action="store_true", help="remove all cached builds")
+    parser.add_argument("--hash", action="store_true", help="print the hash of the sources in $NOOP_HOME")
+    args = parser.parse_args()
+
+    noop_home = os.getenv("NOOP_HOME", os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+    cache = BuildCache(noop_home, args.cache_dir)
+    if args.hash:
+        print(get_source_hash(noop_home))
+    for entry in cache.get_entries():
+        if args.clean:
+            shutil.rmtree(entry, ignore_errors=True)
+        elif args.list:
+            with open(os.path.join(entry, "manifest.json")) as f:
+                manifest = json.load(f)
+            print(f"{os.path.basename(entry)} {manifest['target']:<12} {time.ctime(manifest['time'])}")
@@ -0,0 +1,172 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Cached index of checkpoints
+#
+# Two directory layouts are supported:
+#   with simpoint_summary.json: <gcpt path>/<benchmark>_<point>_<weight>/0/<checkpoint file>
+#   without (autorun):          <gcpt path>/<benchmark>/<point>/<checkpoint file>
+# Listing every checkpoint directory on NFS is slow, so the index is saved under
+# ~/.cache/xiangshan/checkpoints (or $XS_CHECKPOINT_CACHE) and rebuilt only when the
+# json file, the gcpt path or a benchmark or point directory has a different mtime.
+# Checking these takes a stat per checkpoint, but no directory listing.
+#
+#   python3 checkpoints.py <gcpt path> [<json path>] --random
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+
+
+DEFAULT_CACHE_DIR = os.getenv("XS_CHECKPOINT_CACHE", os.path.expanduser("~/.cache/xiangshan/checkpoints"))
+
+point_dir_pattern = re.compile(r'\d+')
+
+
+def get_mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def get_checkpoint_file(directory):
+    checkpoint_file = os.listdir(directory)
+    assert(len(checkpoint_file) == 1)
+    checkpoint_file = os.path.join(directory, checkpoint_file[0])
+    assert(os.path.isfile(checkpoint_file))
+    return checkpoint_file
+
+
+# every scan returns the checkpoints and (path, mtime) of its sources, an mtime is
+# taken before its path is read, so changes during the scan invalidate the index
+
+def scan_simpoint(gcpt_path, json_path):
+    sources = [(json_path, get_mtime(json_path)), (gcpt_path, get_mtime(gcpt_path))]
+    with open(json_path) as f:
+        data = json.load(f)
+    checkpoints = []
+    for benchspec in data:
+        for point in data[benchspec]:
+            weight = data[benchspec][point]
+            point_dir = os.path.join(gcpt_path, "_".join([benchspec, point, weight]), "0")
+            # replacing the checkpoint file changes the mtime of its directory
+            sources.append((point_dir, get_mtime(point_dir)))
+            checkpoints.append((benchspec, point, weight, get_checkpoint_file(point_dir)))
+    return checkpoints, sources
+
+
+def scan_autorun(gcpt_path):
+    checkpoints, sources = [], [(gcpt_path, get_mtime(gcpt_path))]
+    for benchspec in sorted(os.listdir(gcpt_path)):
+        benchspec_dir = os.path.join(gcpt_path, benchspec)
+        if not os.path.isdir(benchspec_dir):
+            continue
+        sources.append((benchspec_dir, get_mtime(benchspec_dir)))
+        for point in sorted(os.listdir(benchspec_dir)):
+            point_dir = os.path.join(benchspec_dir, point)
+            if not point_dir_pattern.match(point) or not os.path.isdir(point_dir):
+                continue
+            sources.append((point_dir, get_mtime(point_dir)))
+            checkpoint_file = os.path.join(point_dir, os.listdir(point_dir)[0])
+            assert(os.path.isfile(checkpoint_file))
+            checkpoints.append((benchspec, point, None, checkpoint_file))
+    return checkpoints, sources
+
+
+def get_cache_path(gcpt_path, json_path, cache_dir):
+    key = hashlib.sha1(f"{os.path.realpath(gcpt_path)}:{json_path and os.path.realpath(json_path)}".encode()).hexdigest()
+    return os.path.join(cache_dir, key + ".json")
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        for path, mtime in cache["sources"]:
+            if get_mtime(path) != mtime:
+                return None
+        return cache["checkpoints"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_cache(cache_path, sources, checkpoints):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        cache = {"sources": sources, "checkpoints": checkpoints}
+        # write and rename, so concurrent readers never see a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"[WARNING] checkpoint index is not saved: {e}")
+
+
+def load_checkpoints(gcpt_path, json_path=None, cache_dir=DEFAULT_CACHE_DIR, rebuild=False):
+    """All checkpoints of a profile, from the index if it is up to date
+
+    Args:
+        gcpt_path (str): checkpoint directory
+        json_path (str): simpoint_summary.json, None for the autorun layout
+        cache_dir (str): index directory, None to disable the index
+        rebuild (bool): ignore the saved index
+
+    Returns:
+        list: dict(benchmark, point, weight, path, size) of every checkpoint,
+        weight is None in the autorun layout
+    """
+    cache_path = get_cache_path(gcpt_path, json_path, cache_dir) if cache_dir is not None else None
+    if cache_path is not None and not rebuild:
+        checkpoints = load_cache(cache_path)
+        if checkpoints is not None:
+            return checkpoints
+    if json_path is None:
+        found, sources = scan_autorun(gcpt_path)
+    else:
+        found, sources = scan_simpoint(gcpt_path, json_path)
+    checkpoints = []
+    for benchspec, point, weight, path in found:
+        checkpoints.append({
+            "benchmark": benchspec,
+            "point": point,
+            "weight": weight,
+            "path": path,
+            "size": os.path.getsize(path)
+        })
+    if cache_path is not None:
+        save_cache(cache_path, sources, checkpoints)
+    return checkpoints
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="list checkpoints from the cached index")
+    parser.add_argument("gcpt_path", type=str, help="checkpoint directory")
+    parser.add_argument("json_path", nargs="?", type=str, help="simpoint_summary.json (default: autorun layout)")
+    parser.add_argument("--benchmark", "-b", type=str, help="only checkpoints of this benchmark")
+    parser.add_argument("--random", action="store_true", help="print one random checkpoint")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the index")
+    args = parser.parse_args()
+
+    checkpoints = load_checkpoints(args.gcpt_path, args.json_path, rebuild=args.rebuild)
+    if args.benchmark is not None:
+        checkpoints = [c for c in checkpoints if c["benchmark"] == args.benchmark]
+    if args.random:
+        checkpoints = [random.choice(checkpoints)] if checkpoints else []
+    for c in checkpoints:
+        print(f"{c['benchmark']} {c['point']} {c['weight']} {c['size']} {c['path']}")
@@ -0,0 +1,245 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Core windows for concurrent emu runs on one host
+#
+# Every logical CPU has a lock file in a shared directory. A window of n CPUs on one
+# NUMA node is allocated by flock-ing all its files without blocking, so concurrent
+# runs (of any user, any window size) never share a CPU. The kernel drops the locks
+# when the holder exits, even if it is killed, so nothing is left to clean up.
+# Processes that do not take the locks are only seen through the CPU load. With
+# --max-load, windows with a CPU busier than that percent are skipped as well, but every
+# attempt then samples the load for one second.
+#
+#   python3 cores.py 8 -- $NOOP_HOME/build/emu -i ...   # runs with numactl on 8 free cores
+#   python3 cores.py --status
+
+import argparse
+import fcntl
+import os
+import subprocess
+import sys
+import time
+
+
+DEFAULT_LOCK_DIR = "/tmp/xiangshan-cores"
+
+
+def parse_cpulist(cpulist):
+    """"0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for item in cpulist.strip().split(","):
+        if not item:
+            continue
+        first, _, last = item.partition("-")
+        cpus += list(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """[0, 1, 2, 3, 8] -> "0-3,8" """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{first}-{last}" if first != last else str(first) for first, last in ranges)
+
+
+def get_numa_nodes(sysfs="/sys/devices/system/node"):
+    """NUMA node -> CPUs this process may run on, one node 0 if sysfs has no topology"""
+    allowed = os.sched_getaffinity(0)
+    nodes = {}
+    if os.path.isdir(sysfs):
+        for name in os.listdir(sysfs):
+            if not name.startswith("node") or not name[4:].isdigit():
+                continue
+            with open(os.path.join(sysfs, name, "cpulist")) as f:
+                cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    if not nodes:
+        nodes[0] = sorted(allowed)
+    return dict(sorted(nodes.items()))
+
+
+class CoreWindow(object):
+    """CPUs locked for one run, released by release() or when the process exits"""
+    def __init__(self, node, cpus, fds):
+        self.node = node
+        self.cpus = cpus
+        self.fds = fds
+
+    def numactl_args(self):
+        return f"numactl -m {self.node} -C {format_cpulist(self.cpus)}"
+
+    def release(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __repr__(self):
+        return f"node {self.node} cpus {format_cpulist(self.cpus)}"
+
+
+class CoreAllocator(object):
+    def __init__(self, lock_dir=DEFAULT_LOCK_DIR, max_load=None):
+        """
+        Args:
+            lock_dir (str): directory of the lock files, shared by all users
+            max_load (float): percent of CPU load of a busy CPU, None to only check the locks
+        """
+        self.lock_dir = lock_dir
+        self.max_load = max_load
+        self.nodes = get_numa_nodes()
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+            try:
+                # shared by all users like /tmp
+                os.chmod(lock_dir, 0o1777)
+            except PermissionError:
+                pass
+
+    def get_windows(self, n):
+        """All windows of n CPUs that do not span NUMA nodes, in allocation order"""
+        windows = []
+        for node, cpus in self.nodes.items():
+            for i in range(0, len(cpus) - n + 1, n):
+                windows.append((node, cpus[i:i + n]))
+        return windows
+
+    def __lock_cpu(self, cpu):
+        path = os.path.join(self.lock_dir, f"cpu{cpu}")
+        try:
+            # flock works on read-only files, so lock files of other users can be locked
+            fd = os.open(path, os.O_CREAT | os.O_RDONLY, 0o666)
+        except PermissionError:
+            return None
+        try:
+            # the umask took the write bits of other users away
+            os.fchmod(fd, 0o666)
+        except PermissionError:
+            pass
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def get_loaded_cpus(self):
+        """CPUs busier than max_load percent, sampled for one second, none without max_load"""
+        if self.max_load is None:
+            return set()
+        import psutil
+        load = psutil.cpu_percent(interval=1, percpu=True)
+        return {cpu for cpu, percent in enumerate(load) if percent > self.max_load}
+
+    def try_acquire(self, n):
+        """A free window of n CPUs, or None if all windows are (partly) taken or loaded"""
+        loaded = self.get_loaded_cpus()
+        for node, cpus in self.get_windows(n):
+            if loaded.intersection(cpus):
+                continue
+            fds = []
+            for cpu in cpus:
+                fd = self.__lock_cpu(cpu)
+                if fd is None:
+                    break
+                fds.append(fd)
+            if len(fds) == n:
+                return CoreWindow(node, cpus, fds)
+            for fd in fds:
+                os.close(fd)
+        return None
+
+    def acquire(self, n, timeout=None, retry=1, stop=None):
+        """Wait until a window of n CPUs is free
+
+        Args:
+            n (int): number of CPUs
+            timeout (float): seconds to wait, forever if None
+            retry (float): seconds between attempts, an attempt only tries the lock files
+                unless max_load is set
+            stop (threading.Event): stop waiting when it is set
+
+        Returns:
+            CoreWindow: None if timed out or stopped
+        """
+        assert any(len(cpus) >= n for cpus in self.nodes.values()), f"No NUMA node has {n} CPUs"
+        start = time.time()
+        waiting = False
+        while stop is None or not stop.is_set():
+            window = self.try_acquire(n)
+            if window is not None:
+                return window
+            if timeout is not None and time.time() - start >= timeout:
+                return None
+            if not waiting:
+                print(f"No free {n} cores found, waiting for one")
+                waiting = True
+            if stop is not None:
+                stop.wait(retry)
+            else:
+                time.sleep(retry)
+        return None
+
+    def get_busy_cpus(self):
+        busy = []
+        for cpus in self.nodes.values():
+            for cpu in cpus:
+                fd = self.__lock_cpu(cpu)
+                if fd is None:
+                    busy.append(cpu)
+                else:
+                    os.close(fd)
+        return busy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run a command on a free core window")
+    parser.add_argument("threads", nargs="?", type=int, help="number of cores")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="command to run with numactl")
+    parser.add_argument("--lock-dir", type=str, default=DEFAULT_LOCK_DIR, help="directory of lock files")
+    parser.add_argument("--timeout", type=float, help="seconds to wait for free cores")
+    parser.add_argument("--max-load", type=float, help="also skip cores busier than this percent, sampled for one second")
+    parser.add_argument("--status", action="store_true", help="print NUMA nodes and busy cores")
+    args = parser.parse_args()
+
+    allocator = CoreAllocator(args.lock_dir, args.max_load)
+    if args.status or args.threads is None:
+        for node, cpus in allocator.nodes.items():
+            print(f"node {node}: {format_cpulist(cpus)}")
+        print(f"busy: {format_cpulist(allocator.get_busy_cpus())}")
+        if args.max_load is not None:
+            print(f"loaded: {format_cpulist(allocator.get_loaded_cpus())}")
+        sys.exit(0)
+    window = allocator.acquire(args.threads, args.timeout)
+    if window is None:
+        sys.exit(1)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    with window:
+        print(f"Running on {window}")
+        if not command:
+            sys.exit(0)
+        sys.exit(subprocess.call(window.numactl_args().split() + command))
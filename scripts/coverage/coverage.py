@@ -19,93 +19,197 @@
 
 import sys
 import re
-import copy
+import argparse
+
+# the line coverage result at the beginning of an annotated line, e.g. " 000417" or "%000000"
+COVERAGE_PATTERN = re.compile(r'^\s*(%?\d+)\s+')
+
+IFDEF = "`ifdef"
+IFNDEF = "`ifndef"
+ENDIF = "`endif"
+
+class ExcludedBlock(object):
+    """A macro block whose line coverage results are removed
+
+    Args:
+        name (str): name of the block
+        directive (str): the directive that opens the block, IFDEF or IFNDEF
+        macro (str): the macro that opens the block
+    """
+    def __init__(self, name, directive, macro):
+        self.name = name
+        self.directive = directive
+        self.opening = directive + " " + macro
+        self.nest_level = 0
+        self.removed_lines = 0
+
+    def update(self, line, is_ifdef, is_ifndef, is_endif):
+        """Track the nest level with this line
+
+        Returns:
+            bool: whether this line is inside the block
+        """
+        is_opening = self.opening in line
+        # enter the block
+        if is_opening:
+            assert self.nest_level == 0, "Should not nest %s macro" % self.name
+            self.nest_level = 1
+
+        if self.nest_level == 0:
+            return False
+
+        # the opening directive itself does not increase the nest level
+        if (is_ifdef and not (is_opening and self.directive == IFDEF)) or \
+           (is_ifndef and not (is_opening and self.directive == IFNDEF)):
+            self.nest_level += 1
+        if is_endif:
+            self.nest_level -= 1
+            assert self.nest_level >= 0, "Macro nest level should be >= 0"
+        return True
+
+class ExcludedRegion(object):
+    """A region found by regex whose line coverage results are removed
+
+    Args:
+        name (str): name of the region
+        begin (str): regex of the first line of the region
+        end (str): regex of the last line of the region, None for a single line
+    """
+    def __init__(self, name, begin, end=None):
+        self.name = name
+        self.begin = begin
+        self.end = re.compile(end) if end is not None else None
+        self.active = False
+        self.removed_lines = 0
+
+    def update(self, line, is_begin):
+        """Track whether this line is inside the region
+
+        Returns:
+            bool: whether this line is inside the region
+        """
+        if not self.active and not is_begin:
+            return False
+        if self.end is None:
+            return True
+        # the last line may also be the first one
+        self.active = not self.end.search(line)
+        return True
+
+class Excluder(object):
+    """All exclusion rules compiled into one matcher
+
+    Macro blocks are found by plain substring search on lines with a macro.
+    The beginnings of all regions share one alternation regex, so every
+    line is scanned by exactly one regex no matter how many rules there are.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.blocks = list(filter(lambda r: isinstance(r, ExcludedBlock), rules))
+        self.regions = list(filter(lambda r: isinstance(r, ExcludedRegion), rules))
+        self.region_begin = None
+        if self.regions:
+            self.region_begin = re.compile("|".join(
+                map(lambda x: f"(?P<r{x[0]}>{x[1].begin})", enumerate(self.regions))))
+        self.in_block = False
+
+    def exclude(self, line):
+        """Returns the rule that excludes this line, or None"""
+        excluded_by = None
+        # fast path: nothing to track outside blocks without any macro
+        if self.in_block or "`" in line:
+            is_ifdef = IFDEF in line
+            is_ifndef = IFNDEF in line
+            is_endif = ENDIF in line
+            # every block is updated to keep the nest levels consistent
+            for block in self.blocks:
+                if block.update(line, is_ifdef, is_ifndef, is_endif) and excluded_by is None:
+                    excluded_by = block
+            self.in_block = any(block.nest_level > 0 for block in self.blocks)
+        if self.region_begin is not None:
+            begin_match = self.region_begin.search(line)
+            begin_index = int(begin_match.lastgroup[1:]) if begin_match else -1
+            for i, region in enumerate(self.regions):
+                if region.update(line, i == begin_index) and excluded_by is None:
+                    excluded_by = region
+        return excluded_by
+
+    def report(self):
+        for rule in self.rules:
+            print(f"{rule.name}: removed {rule.removed_lines} lines")
+
+def get_default_blocks():
+    return [
+        # remove the line coverage results of not synthesizable code(mostly assert and fwrite)
+        ExcludedBlock("SYNTHESIS", IFNDEF, "SYNTHESIS"),
+        # remove the coverage results of random init variables
+        ExcludedBlock("reg_init", IFDEF, "RANDOMIZE_REG_INIT"),
+        ExcludedBlock("mem_init", IFDEF, "RANDOMIZE_MEM_INIT")
+    ]
+
+def load_rules(rule_file):
+    """Load exclusion rules from file
+
+    One rule per line, fields separated by whitespace (use \\s in regex):
+        ifdef   MACRO
+        ifndef  MACRO
+        region  NAME BEGIN_REGEX [END_REGEX]
+        module  NAME MODULE_NAME_REGEX
+    Empty lines and lines starting with # are ignored.
+    """
+    rules = []
+    with open(rule_file) as f:
+        for i, line in enumerate(f):
+            items = line.split()
+            if not items or items[0].startswith("#"):
+                continue
+            kind = items[0]
+            if kind == "ifdef" or kind == "ifndef":
+                assert len(items) == 2, f"{rule_file}:{i + 1}: expect {kind} MACRO"
+                rules.append(ExcludedBlock(items[1], "`" + kind, items[1]))
+            elif kind == "region":
+                assert len(items) in [3, 4], f"{rule_file}:{i + 1}: expect region NAME BEGIN_REGEX [END_REGEX]"
+                rules.append(ExcludedRegion(*items[1:]))
+            elif kind == "module":
+                assert len(items) == 3, f"{rule_file}:{i + 1}: expect module NAME MODULE_NAME_REGEX"
+                rules.append(ExcludedRegion(items[1], r"^\s*module\s+(?:" + items[2] + r")\b", r"^\s*endmodule\b"))
+            else:
+                assert False, f"{rule_file}:{i + 1}: unknown rule {kind}"
+    return rules
+
+def remove_coverage(line):
+    coverage_match = COVERAGE_PATTERN.match(line)
+    if coverage_match:
+        begin, end = coverage_match.span(1)
+        line = line[:begin] + " " * (end - begin) + line[end:]
+        return line, True
+    return line, False
+
+def strip_excluded_blocks(input_file, output_file, rules=None):
+    """Remove line coverage results inside excluded blocks and regions
+
+    Lines are streamed from input_file to output_file in a single pass.
+    """
+    if rules is None:
+        rules = get_default_blocks()
+    excluder = Excluder(rules)
+    with open(input_file, buffering=1 << 20) as fin, open(output_file, "w", buffering=1 << 20) as fout:
+        write = fout.write
+        for line in fin:
+            rule = excluder.exclude(line)
+            if rule is not None:
+                line, removed = remove_coverage(line)
+                rule.removed_lines += removed
+            write(line)
+    return excluder
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 3, "Expect input_file and output_file"
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    lines = []
-    line_count = 0
-    synthesis_nest_level = 0
-    reg_init_nest_level = 0
-    mem_init_nest_level = 0
-    with open(input_file) as f:
-        for line in f:
-            line_count += 1
-
-            ifdef = re.compile('`ifdef')
-            ifndef = re.compile('`ifndef')
-            endif = re.compile('`endif')
-            # remove the line coverage results of not synthesizable code(mostly assert and fwrite)
-            synthesis = re.compile('`ifndef SYNTHESIS')
-            # remove the coverage results of random init variables
-            reg_init = re.compile('`ifdef RANDOMIZE_REG_INIT')
-            mem_init = re.compile('`ifdef RANDOMIZE_MEM_INIT')
-            coverage = re.compile('^\s*(%?\d+)\s+')
-
-
-            ifdef_match = ifdef.search(line)
-            ifndef_match = ifndef.search(line)
-            endif_match = endif.search(line)
-            synthesis_match = synthesis.search(line)
-            reg_init_match = reg_init.search(line)
-            mem_init_match = mem_init.search(line)
-            coverage_match = coverage.search(line)
-
-            # enter synthesis block
-            if synthesis_match:
-                assert synthesis_nest_level == 0, "Should not nest SYNTHESIS macro"
-                synthesis_nest_level = 1
-
-            if synthesis_nest_level > 0:
-                if ifdef_match or (ifndef_match and not synthesis_match):
-                    synthesis_nest_level += 1
-                if endif_match:
-                    synthesis_nest_level -= 1
-                    assert synthesis_nest_level >= 0, "Macro nest level should be >= 0"
-
-                # remove line coverage results in systhesis block
-                if coverage_match:
-                    coverage_stat = coverage_match.group(1)
-                    line = line.replace(coverage_match.group(1), " " * len(coverage_stat))
-
-            # enter reg_init block
-            if reg_init_match:
-                assert reg_init_nest_level == 0, "Should not nest reg_init macro"
-                reg_init_nest_level = 1
-
-            if reg_init_nest_level > 0:
-                if (ifdef_match and not reg_init_match) or ifndef_match:
-                    reg_init_nest_level += 1
-                if endif_match:
-                    reg_init_nest_level -= 1
-                    assert reg_init_nest_level >= 0, "Macro nest level should be >= 0"
-
-                # remove line coverage results in systhesis block
-                if coverage_match:
-                    coverage_stat = coverage_match.group(1)
-                    line = line.replace(coverage_match.group(1), " " * len(coverage_stat))
-
-            # enter mem_init block
-            if mem_init_match:
-                assert mem_init_nest_level == 0, "Should not nest mem_init macro"
-                mem_init_nest_level = 1
-
-            if mem_init_nest_level > 0:
-                if (ifdef_match and not mem_init_match) or ifndef_match:
-                    mem_init_nest_level += 1
-                if endif_match:
-                    mem_init_nest_level -= 1
-                    assert mem_init_nest_level >= 0, "Macro nest level should be >= 0"
-
-                # remove line coverage results in systhesis block
-                if coverage_match:
-                    coverage_stat = coverage_match.group(1)
-                    line = line.replace(coverage_match.group(1), " " * len(coverage_stat))
-
-            lines += line
-
-    with open(output_file, "w") as f:
-        for line in lines:
-            f.write(line)
+    parser = argparse.ArgumentParser(description="remove coverage results of excluded code")
+    parser.add_argument("input_file", type=str, help="annotated verilog file")
+    parser.add_argument("output_file", type=str, help="output file")
+    parser.add_argument("--rules", "-r", type=str, help="exclusion rule file (default: SYNTHESIS and RANDOMIZE_*_INIT)")
+    args = parser.parse_args()
+
+    rules = load_rules(args.rules) if args.rules is not None else None
+    excluder = strip_excluded_blocks(args.input_file, args.output_file, rules)
+    excluder.report()
@@ -21,7 +21,12 @@
 import sys
 import re
 import copy
+import csv
+import json
+import mmap
 import pprint
+import argparse
+from multiprocessing import Pool
 
 LINE_COVERRED = "LINE_COVERRED"
 NOT_LINE_COVERRED = "NOT_LINE_COVERRED"
@@ -39,6 +44,8 @@ ROOT = "ROOT"
 NODE = "NODE"
 SELFCOVERAGE = "SELFCOVERAGE"
 TREECOVERAGE = "TREECOVERAGE"
+WEIGHTEDCOVERAGE = "WEIGHTEDCOVERAGE"
+INSTANCECOUNT = "INSTANCECOUNT"
 LINECOVERAGE = 0
 TOGGLECOVERAGE = 1
 
@@ -204,43 +211,151 @@ def get_modules(lines):
         line_count += 1
     return modules
 
-# we define two coverage metrics:
+# get the byte offsets and line numbers of every module with a cheap scan over the raw file
+# returns [(name, begin_offset, end_offset, begin_line, end_line)], ranges are [begin, end)
+def get_module_index(input_file):
+    index = []
+    module_or_endmodule = re.compile(rb"module (\w+)\(|endmodule")
+    with open(input_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        name = None
+        line_count, last = 0, 0
+        for match in module_or_endmodule.finditer(mm):
+            line_begin = mm.rfind(b"\n", 0, match.start()) + 1
+            line_count += mm[last:line_begin].count(b"\n")
+            last = line_begin
+            if match.group(1) is not None:
+                assert name is None, "Should not nest module definitions"
+                name = match.group(1).decode()
+                begin_offset, begin_line = line_begin, line_count
+            else:
+                assert name is not None
+                line_end = mm.find(b"\n", match.end())
+                end_offset = len(mm) if line_end == -1 else line_end + 1
+                index.append((name, begin_offset, end_offset, begin_line, line_count + 1))
+                name = None
+    return index
+
+# the annotated file mapped once in each worker process
+shared_mmap = None
+
+def open_shared_mmap(input_file):
+    global shared_mmap
+    f = open(input_file, "rb")
+    shared_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# annotate and count one module range, also collect the submodules instantiated inside
+def get_range_statistics(module_range):
+    name, begin_offset, end_offset = module_range[:3]
+    lines = shared_mmap[begin_offset:end_offset].decode().splitlines(keepends=True)
+    annotations = get_line_annotation(lines)
+    coverage = get_coverage_statistics(annotations, 0, len(annotations))
+    submodule_pattern = re.compile(r"(\w+) (\w+) \( // @\[\w+.scala \d+:\d+\]")
+    submodules = []
+    for line in lines:
+        submodule_match = submodule_pattern.search(line)
+        if submodule_match:
+            submodules.append((submodule_match.group(1), submodule_match.group(2)))
+    return name, coverage, submodules
+
+# the parallel version of get_modules and get_coverage_statistics
+# returns the same modules dict and self coverage dict
+def get_modules_parallel(input_file, jobs):
+    index = get_module_index(input_file)
+    with Pool(jobs, initializer=open_shared_mmap, initargs=(input_file,)) as pool:
+        results = pool.map(get_range_statistics, index, chunksize=max(1, len(index) // (jobs * 16)))
+
+    modules = {}
+    self_coverage = {}
+    # merge in file order, so submodules must be defined first as in get_modules
+    for (name, _, _, begin_line, end_line), (_, coverage, submodules) in zip(index, results):
+        assert name not in modules
+        modules[name] = {BEGIN: begin_line, END: end_line, TYPE: ROOT}
+        self_coverage[name] = coverage
+        for submodule_type, submodule_instance in submodules:
+            if submodule_type not in modules:
+                print("Module %s is a Blackbox" % submodule_type)
+            else:
+                modules[submodule_type][TYPE] = NODE
+                if CHILDREN not in modules[name]:
+                    modules[name][CHILDREN] = []
+                modules[name][CHILDREN].append({MODULE: submodule_type, INSTANCE: submodule_instance})
+    return modules, self_coverage
+
+# count how many times each child module is instantiated by its parent
+def get_children_count(modules, module):
+    children_count = {}
+    for child in modules[module].get(CHILDREN, []):
+        children_count[child[MODULE]] = children_count.get(child[MODULE], 0) + 1
+    return children_count
+
+# sort modules so that every parent comes before all of its submodules
+# (Kahn's algorithm, no recursion so deep hierarchies are fine)
+def get_topological_order(modules):
+    in_degree = {module: 0 for module in modules}
+    for module in modules:
+        for child in get_children_count(modules, module):
+            in_degree[child] += 1
+    order = [module for module in modules if in_degree[module] == 0]
+    i = 0
+    while i < len(order):
+        for child in get_children_count(modules, order[i]):
+            in_degree[child] -= 1
+            if in_degree[child] == 0:
+                order.append(child)
+        i += 1
+    assert len(order) == len(modules), "Module hierarchy should not contain cycles"
+    return order
+
+def get_coverage_from_counts(line_coverred, not_line_coverred, toggle_coverred, not_toggle_coverred):
+    # deal with divide by zero
+    line_coverage = 1.0
+    if line_coverred + not_line_coverred != 0:
+        line_coverage = float(line_coverred) / (line_coverred + not_line_coverred)
+    toggle_coverage = 1.0
+    if toggle_coverred + not_toggle_coverred != 0:
+        toggle_coverage = float(toggle_coverred) / (toggle_coverred + not_toggle_coverred)
+    return ((line_coverred, not_line_coverred, line_coverage),
+            (toggle_coverred, not_toggle_coverred, toggle_coverage))
+
+# we define three coverage metrics:
 # self coverage: coverage results of this module(excluding submodules)
 # tree coverage: coverage results of this module(including submodules)
+# weighted coverage: self coverage multiplied by the number of times this module
+#                    is instantiated in the whole design (a module instantiated
+#                    8 times counts 8 times), which is what coverage closure needs
 def get_tree_coverage(modules, coverage):
-    def dfs(module):
-        if TREECOVERAGE not in modules[module]:
-            self_coverage = modules[module][SELFCOVERAGE]
-            if CHILDREN not in modules[module]:
-                modules[module][TREECOVERAGE] = self_coverage
-            else:
-                line_coverred = self_coverage[LINECOVERAGE][0]
-                not_line_coverred = self_coverage[LINECOVERAGE][1]
-                toggle_coverred = self_coverage[TOGGLECOVERAGE][0]
-                not_toggle_coverred = self_coverage[TOGGLECOVERAGE][1]
-                # the dfs part
-                for child in modules[module][CHILDREN]:
-                    child_coverage = dfs(child[MODULE])
-                    line_coverred += child_coverage[LINECOVERAGE][0]
-                    not_line_coverred += child_coverage[LINECOVERAGE][1]
-                    toggle_coverred += child_coverage[TOGGLECOVERAGE][0]
-                    not_toggle_coverred += child_coverage[TOGGLECOVERAGE][1]
-                # deal with divide by zero
-                line_coverage = 1.0
-                if line_coverred + not_line_coverred != 0:
-                    line_coverage = float(line_coverred) / (line_coverred + not_line_coverred)
-                toggle_coverage = 1.0
-                if toggle_coverred + not_toggle_coverred != 0:
-                    toggle_coverage = float(toggle_coverred) / (toggle_coverred + not_toggle_coverred)
-                modules[module][TREECOVERAGE] = ((line_coverred, not_line_coverred, line_coverage),
-                        (toggle_coverred, not_toggle_coverred, toggle_coverage))
-        return modules[module][TREECOVERAGE]
-
     for module in modules:
         modules[module][SELFCOVERAGE] = coverage[module]
 
+    order = get_topological_order(modules)
+
+    # parents first: propagate instance multiplicity from the roots down
     for module in modules:
-        modules[module][TREECOVERAGE] = dfs(module)
+        modules[module][INSTANCECOUNT] = 1 if modules[module][TYPE] == ROOT else 0
+    for module in order:
+        for child, count in get_children_count(modules, module).items():
+            modules[child][INSTANCECOUNT] += modules[module][INSTANCECOUNT] * count
+
+    # children first: each tree coverage is computed exactly once
+    for module in reversed(order):
+        self_coverage = modules[module][SELFCOVERAGE]
+        line_coverred = self_coverage[LINECOVERAGE][0]
+        not_line_coverred = self_coverage[LINECOVERAGE][1]
+        toggle_coverred = self_coverage[TOGGLECOVERAGE][0]
+        not_toggle_coverred = self_coverage[TOGGLECOVERAGE][1]
+        for child in modules[module].get(CHILDREN, []):
+            child_coverage = modules[child[MODULE]][TREECOVERAGE]
+            line_coverred += child_coverage[LINECOVERAGE][0]
+            not_line_coverred += child_coverage[LINECOVERAGE][1]
+            toggle_coverred += child_coverage[TOGGLECOVERAGE][0]
+            not_toggle_coverred += child_coverage[TOGGLECOVERAGE][1]
+        modules[module][TREECOVERAGE] = get_coverage_from_counts(
+            line_coverred, not_line_coverred, toggle_coverred, not_toggle_coverred)
+
+        count = modules[module][INSTANCECOUNT]
+        modules[module][WEIGHTEDCOVERAGE] = get_coverage_from_counts(
+            self_coverage[LINECOVERAGE][0] * count, self_coverage[LINECOVERAGE][1] * count,
+            self_coverage[TOGGLECOVERAGE][0] * count, self_coverage[TOGGLECOVERAGE][1] * count)
     return modules
 
 # arg1: tree coverage results
@@ -250,8 +365,16 @@ def sort_coverage(coverage, self_or_tree, coverage_type):
     l.sort(key=lambda x:x[1][2])
     return l
 
+# arg1: tree coverage results
+# arg2: coverage type
+# sort by the number of not coverred items, most not coverred first
+def sort_not_coverred(coverage, self_or_tree, coverage_type):
+    l = [(module, coverage[module][self_or_tree][coverage_type])for module in coverage]
+    l.sort(key=lambda x:x[1][1], reverse=True)
+    return l
+
 def print_tree_coverage(tree_coverage):
-    def dfs(module, level):
+    def print_node(module, level):
         # print current node
         tree = tree_coverage[module][TREECOVERAGE]
         self = tree_coverage[module][SELFCOVERAGE]
@@ -266,42 +389,151 @@ def print_tree_coverage(tree_coverage):
         print("  " * level + "  self_toggle", end="")
         print("(%d, %d, %.2f)" % (self[TOGGLECOVERAGE][0], self[TOGGLECOVERAGE][1], self[TOGGLECOVERAGE][2] * 100.0))
 
-        # print children nodes
-        if CHILDREN in modules[module]:
-                # the dfs part
-                for child in modules[module][CHILDREN]:
-                    dfs(child[MODULE], level + 1)
-
     for module in tree_coverage:
         if tree_coverage[module][TYPE] == ROOT:
-            dfs(module, 0)
+            # explicit stack instead of recursion to survive deep hierarchies
+            stack = [(module, 0)]
+            while stack:
+                node, level = stack.pop()
+                print_node(node, level)
+                # push children in reverse order to print them in source order
+                for child in reversed(tree_coverage[node].get(CHILDREN, [])):
+                    stack.append((child[MODULE], level + 1))
+
+# columns of the machine-readable report, one (name, metric, coverage type) per group
+REPORT_COLUMNS = [
+    ("self_line", SELFCOVERAGE, LINECOVERAGE),
+    ("tree_line", TREECOVERAGE, LINECOVERAGE),
+    ("self_toggle", SELFCOVERAGE, TOGGLECOVERAGE),
+    ("tree_toggle", TREECOVERAGE, TOGGLECOVERAGE),
+    ("weighted_line", WEIGHTEDCOVERAGE, LINECOVERAGE),
+    ("weighted_toggle", WEIGHTEDCOVERAGE, TOGGLECOVERAGE)
+]
+
+# flatten tree coverage results to {module: {column: (coverred, not_coverred, coverage)}}
+def get_report(tree_coverage):
+    report = {}
+    for module in tree_coverage:
+        entry = {"type": tree_coverage[module][TYPE], "instances": tree_coverage[module][INSTANCECOUNT]}
+        for name, self_or_tree, coverage_type in REPORT_COLUMNS:
+            entry[name] = list(tree_coverage[module][self_or_tree][coverage_type])
+        report[module] = entry
+    return report
+
+def get_csv_header():
+    header = ["module", "type", "instances"]
+    for name, _, _ in REPORT_COLUMNS:
+        header += [name + "_coverred", name + "_not_coverred", name + "_coverage"]
+    return header
+
+def write_report(report, output_file):
+    with open(output_file, "w") as f:
+        if output_file.endswith(".csv"):
+            writer = csv.writer(f)
+            writer.writerow(get_csv_header())
+            for module in sorted(report):
+                row = [module, report[module]["type"], report[module]["instances"]]
+                for name, _, _ in REPORT_COLUMNS:
+                    row += report[module][name]
+                writer.writerow(row)
+        else:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+def read_report(input_file):
+    if not input_file.endswith(".csv"):
+        with open(input_file) as f:
+            return json.load(f)
+    report = {}
+    with open(input_file) as f:
+        for row in csv.DictReader(f):
+            entry = {"type": row["type"], "instances": int(row["instances"])}
+            for name, _, _ in REPORT_COLUMNS:
+                entry[name] = [int(row[name + "_coverred"]), int(row[name + "_not_coverred"]),
+                        float(row[name + "_coverage"])]
+            report[row["module"]] = entry
+    return report
+
+# compare two reports and return [(module, column, old, new)] for every changed coverage,
+# a module that only exists in one report is reported with None on the other side
+def compare_report(old_report, new_report, threshold=0.0):
+    changes = []
+    for module in sorted(set(old_report) | set(new_report)):
+        old, new = old_report.get(module), new_report.get(module)
+        for name, _, _ in REPORT_COLUMNS:
+            old_coverage = tuple(old[name]) if old is not None else None
+            new_coverage = tuple(new[name]) if new is not None else None
+            if old_coverage is None or new_coverage is None:
+                if old_coverage != new_coverage:
+                    changes.append((module, name, old_coverage, new_coverage))
+            elif old_coverage[:2] != new_coverage[:2] and \
+                    abs(new_coverage[2] - old_coverage[2]) >= threshold:
+                changes.append((module, name, old_coverage, new_coverage))
+    return changes
+
+def print_compare_report(changes):
+    def fmt(coverage):
+        if coverage is None:
+            return "-"
+        return "(%d, %d, %.2f)" % (coverage[0], coverage[1], coverage[2] * 100.0)
+    for module, name, old, new in changes:
+        delta = ""
+        if old is not None and new is not None:
+            delta = " %+.2f" % ((new[2] - old[2]) * 100.0)
+        print("%s %s %s -> %s%s" % (module, name, fmt(old), fmt(new), delta))
+    print("%d coverage changes in %d modules" % (len(changes), len(set(map(lambda x: x[0], changes)))))
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 2, "Expect input_file"
-    input_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description="coverage statistics of verilator annotated verilog")
+    parser.add_argument("input_file", nargs="?", type=str, help="annotated verilog file")
+    parser.add_argument("--output", "-o", type=str, help="export report to json (or csv if ends with .csv)")
+    parser.add_argument("--quiet", "-q", action="store_true", help="do not pretty-print coverage to stdout")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="analyze module ranges in parallel with this many processes")
+    parser.add_argument("--compare", nargs=2, type=str, metavar=("OLD", "NEW"),
+                        help="compare two exported reports and list modules whose coverage changed")
+    parser.add_argument("--threshold", type=float, default=0.0,
+                        help="only list coverage changes not less than this ratio in compare mode")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        old_report, new_report = map(read_report, args.compare)
+        print_compare_report(compare_report(old_report, new_report, args.threshold))
+        sys.exit(0)
+
+    assert args.input_file is not None, "Expect input_file"
+    input_file = args.input_file
     pp = pprint.PrettyPrinter(indent=4)
 
-    lines = get_lines(input_file)
-    # print("lines:")
-    # pp.pprint(lines)
+    if args.jobs > 1:
+        modules, self_coverage = get_modules_parallel(input_file, args.jobs)
+    else:
+        lines = get_lines(input_file)
+        # print("lines:")
+        # pp.pprint(lines)
 
-    annotations = get_line_annotation(lines)
-    # print("annotations:")
-    # pp.pprint(annotations)
+        annotations = get_line_annotation(lines)
+        # print("annotations:")
+        # pp.pprint(annotations)
 
-    modules = get_modules(lines)
-    # print("modules:")
-    # pp.pprint(modules)
+        modules = get_modules(lines)
+        # print("modules:")
+        # pp.pprint(modules)
 
-    self_coverage = {module: get_coverage_statistics(annotations, modules[module][BEGIN], modules[module][END])
-            for module in modules}
-    # print("self_coverage:")
-    # pp.pprint(self_coverage)
+        self_coverage = {module: get_coverage_statistics(annotations, modules[module][BEGIN], modules[module][END])
+                for module in modules}
+        # print("self_coverage:")
+        # pp.pprint(self_coverage)
 
     tree_coverage = get_tree_coverage(modules, self_coverage)
     # print("tree_coverage:")
     # pp.pprint(tree_coverage)
 
+    if args.output is not None:
+        write_report(get_report(tree_coverage), args.output)
+
+    if args.quiet:
+        sys.exit(0)
+
     print("LineSelfCoverage:")
     pp.pprint(sort_coverage(tree_coverage, SELFCOVERAGE, LINECOVERAGE))
     print("LineTreeCoverage:")
@@ -312,5 +544,10 @@ if __name__ == "__main__":
     print("ToggleTreeCoverage:")
     pp.pprint(sort_coverage(tree_coverage, TREECOVERAGE, TOGGLECOVERAGE))
 
+    print("LineWeightedNotCoverred:")
+    pp.pprint(sort_not_coverred(tree_coverage, WEIGHTEDCOVERAGE, LINECOVERAGE))
+    print("ToggleWeightedNotCoverred:")
+    pp.pprint(sort_not_coverred(tree_coverage, WEIGHTEDCOVERAGE, TOGGLECOVERAGE))
+
     print("AllCoverage:")
     print_tree_coverage(tree_coverage)
@@ -0,0 +1,240 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Simulation speed of emu runs
+#
+# The summary printed by emu to stderr when it stops looks like
+#   Core-0 instrCnt = 1,234,567, cycleCnt = 2,345,678, IPC = 0.526316
+#   Seed=1234 Guest cycle spent: 2,345,679 (this will be different from cycleCnt if emu loads a snapshot)
+#   Host time spent: 12,345ms
+# Speeds of every run are appended to a JSON-lines history with the commit and build
+# configuration, so emu slowdowns from RTL or verilator changes show up across commits.
+#
+#   python3 emu_speed.py --log emu.log                    # speed of one run
+#   python3 emu_speed.py emu-speed.jsonl --threshold 0.1  # compare the latest commit to earlier ones
+
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+DEFAULT_HISTORY = os.getenv("XS_EMU_HISTORY", os.path.expanduser("~/.cache/xiangshan/emu-speed.jsonl"))
+
+counter_re = re.compile(r'(?:Core-?(\d+):?\s+)?instrCnt = ([\d,]+), cycleCnt = ([\d,]+)')
+guest_cycle_re = re.compile(r'Guest cycle spent: ([\d,]+)')
+host_time_re = re.compile(r'Host time spent: ([\d,]+)ms')
+
+
+def parse_int(value):
+    """"1,234,567" -> 1234567, emu prints numbers with thousands separators"""
+    return int(value.replace(",", ""))
+
+
+class EmuProgress(object):
+    """Counters reported by an emu run, updated line by line"""
+    def __init__(self):
+        self.instrs = {}
+        self.cycles = {}
+        self.guest_cycles = None
+        self.host_ms = None
+        self.lock = threading.Lock()
+
+    def feed(self, line):
+        if "Cnt = " not in line and "spent: " not in line:
+            return
+        with self.lock:
+            match = counter_re.search(line)
+            if match:
+                core = int(match.group(1) or 0)
+                self.instrs[core] = parse_int(match.group(2))
+                self.cycles[core] = parse_int(match.group(3))
+            match = guest_cycle_re.search(line)
+            if match:
+                self.guest_cycles = parse_int(match.group(1))
+            match = host_time_re.search(line)
+            if match:
+                self.host_ms = parse_int(match.group(1))
+
+    def get_cycles(self):
+        """cycleCnt reported by emu, None if not reported"""
+        with self.lock:
+            return max(self.cycles.values()) if self.cycles else None
+
+    def get_speed(self):
+        """Simulation speed of the run
+
+        Returns:
+            dict: instrs (all cores), cycles, host_time (seconds), khz and ips,
+            None if emu has not reported its counters
+        """
+        with self.lock:
+            if not self.cycles or not self.host_ms:
+                return None
+            # cycleCnt includes the cycles before a loaded snapshot
+            cycles = self.guest_cycles if self.guest_cycles is not None else max(self.cycles.values())
+            instrs = sum(self.instrs.values())
+            host_time = self.host_ms / 1000
+            return {
+                "instrs": instrs,
+                "cycles": cycles,
+                "host_time": host_time,
+                "khz": cycles / self.host_ms,
+                "ips": instrs / host_time
+            }
+
+
+def format_speed(speed):
+    return f"{speed['cycles']} cycles, {speed['instrs']} instrs in {speed['host_time']:.1f}s: " \
+           f"{speed['khz']:.2f} KHz, {speed['ips']:.0f} instr/s"
+
+
+class OutputTee(object):
+    """Copy the output of a process to a file descriptor and feed every line to an EmuProgress
+
+    The tee writes to its own duplicate of fd, so the caller may close fd while forked
+    children still hold the pipe open. The duplicate is closed when the output ends.
+    """
+    def __init__(self, stream, fd, progress):
+        self.stream = stream
+        self.fd = os.dup(fd)
+        self.progress = progress
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for line in iter(self.stream.readline, b""):
+                if self.fd is not None:
+                    try:
+                        os.write(self.fd, line)
+                    except OSError as e:
+                        # keep reading, or the process blocks on the full pipe
+                        print(f"[WARNING] output is not copied any more: {e}", file=sys.stderr)
+                        os.close(self.fd)
+                        self.fd = None
+                self.progress.feed(line.decode(errors="replace"))
+        finally:
+            self.stream.close()
+            if self.fd is not None:
+                os.close(self.fd)
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+
+def parse_log(filename):
+    progress = EmuProgress()
+    with open(filename, errors="replace") as f:
+        for line in f:
+            progress.feed(line)
+    return progress
+
+
+def get_commit(noop_home):
+    try:
+        commit = subprocess.check_output(["git", "-C", noop_home, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL)
+        dirty = subprocess.call(["git", "-C", noop_home, "diff", "--quiet", "HEAD"], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode().strip() + ("-dirty" if dirty else "")
+
+
+class SpeedHistory(object):
+    """Speeds of emu runs, one JSON object per line, safe for concurrent threads"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def write(self, workload, speed, return_code, commit, build):
+        record = {
+            "time": time.time(),
+            "host": socket.gethostname(),
+            "commit": commit,
+            "build": build,
+            "workload": os.path.basename(workload),
+            "return_code": return_code
+        }
+        record.update(speed)
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def read(self):
+        records = []
+        with open(self.filename) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+        return records
+
+
+def compare_history(records, threshold):
+    """Compare the speed of the latest commit to the median of earlier commits
+
+    Runs are grouped by host, build configuration and workload, so only runs that
+    are expected to have the same speed are compared.
+
+    Returns:
+        list: (host, build, workload, old KHz, new KHz, relative change, regressed)
+    """
+    groups = {}
+    for record in records:
+        key = (record["host"], json.dumps(record["build"], sort_keys=True), record["workload"])
+        groups.setdefault(key, []).append(record)
+    results = []
+    for (host, build, workload), runs in sorted(groups.items()):
+        runs.sort(key=lambda r: r["time"])
+        latest = runs[-1]["commit"]
+        new = [r["khz"] for r in runs if r["commit"] == latest]
+        old = [r["khz"] for r in runs if r["commit"] != latest]
+        if not old:
+            continue
+        old_khz, new_khz = statistics.median(old), statistics.median(new)
+        change = new_khz / old_khz - 1
+        results.append((host, build, workload, old_khz, new_khz, change, change < -threshold))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simulation speed of emu runs")
+    parser.add_argument("history", nargs="?", type=str, default=DEFAULT_HISTORY, help="JSON-lines speed history")
+    parser.add_argument("--log", type=str, help="print the speed of one emu log instead")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    if args.log is not None:
+        speed = parse_log(args.log).get_speed()
+        if speed is None:
+            print(f"No emu summary found in {args.log}")
+            sys.exit(1)
+        print(format_speed(speed))
+        sys.exit(0)
+
+    regressed = False
+    print(f"{'workload':<32} {'old (KHz)':>10} {'new (KHz)':>10} {'change':>8}  build")
+    for host, build, workload, old_khz, new_khz, change, slower in compare_history(SpeedHistory(args.history).read(), args.threshold):
+        mark = " SLOWER" if slower else ""
+        print(f"{workload:<32} {old_khz:>10.2f} {new_khz:>10.2f} {change:>+8.1%}  {host} {build}{mark}")
+        regressed = regressed or slower
+    sys.exit(1 if regressed else 0)
@@ -10,6 +10,8 @@ import subprocess
 
 import xlsxwriter
 
+import verilog_patterns
+
 
 class VIO(object):
     def __init__(self, info):
@@ -43,9 +45,9 @@ class VIO(object):
 
 class VModule(object):
     # module_re = re.compile(r'^\s*module\s*(\w+)\s*(#\(?|)\s*(\(.*|)\s*$')
-    module_re = re.compile(r'^\s*module\s+(\w+)\s*(#\s*\(.+\))?\s*(import\s+\w+\s*::\*\s*;)?\s*(#\s*\()?')
+    module_re = verilog_patterns.module_re
     io_re = re.compile(r'^\s*(input|output)\s*(\[\s*\d+\s*:\s*\d+\s*\]|)\s*(\w+),?\s*$')
-    submodule_re = re.compile(r'^\s*(\w+)\s*(#\(.*\)|)\s*(\w+)\s*\(\s*(|//.*)\s*$')
+    submodule_re = verilog_patterns.submodule_re
     difftest_module_re = re.compile(r'^  \w*Difftest\w+\s+\w+ \( //.*$')
 
     def __init__(self, name):
@@ -374,7 +376,7 @@ def get_files(build_path):
     return files
 
 class SRAMConfiguration(object):
-    ARRAY_NAME = "sram_array_(\d)p(\d+)x(\d+)m(\d+)(_multicycle|)(_repair|)"
+    ARRAY_NAME = verilog_patterns.SRAM_ARRAY_NAME
 
     SINGLE_PORT = 0
     SINGLE_PORT_MASK = 1
@@ -0,0 +1,134 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Split CI workloads into shards of similar run time
+#
+# Durations come from the emu speed history (emu_speed.py) and telemetry files
+# (telemetry.py). Every shard computes the whole plan by itself, so all shards must read
+# the same files (a shared one on NFS, not the history in the home of each runner), and
+# only records written before a common cutoff (the commit time of HEAD in xiangshan.py)
+# are used, otherwise runs that finish during CI change the plan. The plan is printed
+# with a hash, which is the same in all shards if they agree.
+#
+#   python3 shards.py 4 --history /nfs/.../emu-speed.jsonl $AM_HOME/tests/cputest/build/*.bin
+
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import subprocess
+
+
+def parse_shard(value):
+    """argparse type of "i/N", the i-th (from 1) of N shards"""
+    try:
+        index, count = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not i/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index of {value} is not in 1..{count}")
+    return index, count
+
+
+def get_commit_time(noop_home):
+    try:
+        output = subprocess.check_output(["git", "-C", noop_home, "log", "-1", "--format=%ct"], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return float(output.decode().strip())
+
+
+def load_durations(files, before=None):
+    """Median seconds of every workload in speed history and telemetry files
+
+    Args:
+        files (list): JSON-lines files, missing ones are skipped
+        before (float): only records started before this timestamp
+
+    Returns:
+        dict: workload file name -> seconds
+    """
+    samples = {}
+    for filename in files:
+        if not os.path.isfile(filename):
+            continue
+        with open(filename) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "action" in record:
+                    # telemetry: emu:<workload> or simv:<workload>
+                    kind, _, workload = record["action"].partition(":")
+                    if kind not in ("emu", "simv") or record["return_code"] is None:
+                        continue
+                    start, duration = record["start"], record["wall_time"]
+                elif "workload" in record:
+                    workload, start, duration = record["workload"], record["time"], record["host_time"]
+                else:
+                    continue
+                if before is not None and start >= before:
+                    continue
+                samples.setdefault(workload, []).append(duration)
+    return {workload: statistics.median(durations) for workload, durations in samples.items()}
+
+
+def split_lpt(workloads, durations, count):
+    """Greedy longest-processing-time split of workloads into count shards
+
+    Workloads without a recorded duration count as the median of the recorded ones.
+    The result does not depend on the order of workloads.
+
+    Returns:
+        list: (estimated seconds, workloads) of every shard
+    """
+    known = [durations[os.path.basename(w)] for w in workloads if os.path.basename(w) in durations]
+    default = statistics.median(known) if known else 1.0
+    estimated = {w: durations.get(os.path.basename(w), default) for w in workloads}
+    shards = [(0.0, []) for _ in range(count)]
+    for workload in sorted(workloads, key=lambda w: (-estimated[w], w)):
+        # the least loaded shard, the first one on ties
+        i = min(range(count), key=lambda i: shards[i][0])
+        shards[i] = (shards[i][0] + estimated[workload], shards[i][1] + [workload])
+    return shards
+
+
+def get_plan_hash(shards):
+    """Short hash of the workload names in every shard"""
+    plan = [[os.path.basename(w) for w in workloads] for _, workloads in shards]
+    return hashlib.sha256(json.dumps(plan).encode()).hexdigest()[:12]
+
+
+def print_plan(shards, index=None):
+    print(f"shard plan {get_plan_hash(shards)}")
+    for i, (seconds, workloads) in enumerate(shards, 1):
+        mark = " <-" if i == index else ""
+        print(f"shard {i}/{len(shards)}: {len(workloads)} workloads, {seconds:.0f}s estimated{mark}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="split workloads into shards by recorded run time")
+    parser.add_argument("count", type=int, help="number of shards")
+    parser.add_argument("workloads", nargs="+", type=str, help="workload files")
+    parser.add_argument("--history", action="append", default=[], help="speed history or telemetry file")
+    args = parser.parse_args()
+
+    shards = split_lpt(args.workloads, load_durations(args.history), args.count)
+    print_plan(shards)
+    for i, (_, workloads) in enumerate(shards, 1):
+        for workload in workloads:
+            print(f"{i} {workload}")
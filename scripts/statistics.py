@@ -15,7 +15,11 @@
 #***************************************************************************************
 
 import os
+import re
 import argparse
+from multiprocessing import Pool
+
+from verilog_patterns import SRAM_ARRAY_NAME, module_re, submodule_re
 
 def printMap(mp):
     len_key = max(map(lambda s: len(s), mp.keys()))
@@ -24,68 +28,194 @@ def printMap(mp):
     total = sum(mp.values())
     for k,v in sorted(mp.items(), key=lambda x:x[1], reverse=True):
         print(
-            pattern.format(k, v, round(v*100.0/total, 3))
+            pattern.format(k, v, round(v*100.0/total, 3) if total else 0)
         )
 
 
-def analyzeVerilog(filename):
-    mymap = {}
-    last = ""
+# reg [W:0] name; or reg [W:0] name [0:D-1]; (memory)
+reg_re = re.compile(r'^\s*reg\s*(?:\[\s*(\d+)\s*:\s*(\d+)\s*\])?\s*(\w+)\s*(?:\[\s*(\d+)\s*:\s*(\d+)\s*\])?\s*;')
+# SRAM array modules, after an optional module prefix
+sram_array_re = re.compile(SRAM_ARRAY_NAME + "$")
+
+class ModuleSize(object):
+    def __init__(self, name):
+        self.name = name
+        self.lines = 0
+        self.reg_bits = 0
+        self.mem_bits = 0
+        # submodule name -> number of instances in this module
+        self.submodule = {}
+        self.instances = 0
+        # sizes of this module with all its submodules
+        self.flat_lines = 0
+        self.flat_reg_bits = 0
+        self.flat_mem_bits = 0
+
+def getModuleSizes(filename):
+    """Lines, register bits, memory bits and submodules of every module in one pass
+
+    Returns:
+        dict: module name -> ModuleSize
+    """
+    sizes = {}
+    current = None
     with open(filename, "r") as f:
-        line = f.readline()
-        cnt = 0
-        while(line):
-            if "module " in line:
-                if last!="" :
-                    mymap[last] = cnt
-                last = line[7:-2]
-                cnt = 1
-            else:
-                cnt = cnt + 1
-            line = f.readline()
-        mymap[last] = cnt
-        printMap(mymap)
+        for line in f:
+            if current is None:
+                module_match = module_re.match(line)
+                if module_match:
+                    current = ModuleSize(module_match.group(1))
+                    current.lines = 1
+                continue
+            current.lines += 1
+            if line.startswith("endmodule"):
+                sizes[current.name] = current
+                current = None
+                continue
+            reg_match = reg_re.match(line)
+            if reg_match:
+                msb, lsb, name, first, last = reg_match.groups()
+                # _RAND_* only exist for random initialization in simulation
+                if name.startswith("_RAND_"):
+                    continue
+                width = abs(int(msb) - int(lsb)) + 1 if msb is not None else 1
+                if first is not None:
+                    current.mem_bits += width * (abs(int(last) - int(first)) + 1)
+                else:
+                    current.reg_bits += width
+                continue
+            submodule_match = submodule_re.match(line)
+            if submodule_match and submodule_match.group(1) != "module":
+                submodule = submodule_match.group(1)
+                current.submodule[submodule] = current.submodule.get(submodule, 0) + 1
+    # SRAM arrays replaced by macros do not have a reg array
+    for size in sizes.values():
+        sram_match = sram_array_re.search(size.name) if size.mem_bits == 0 else None
+        if sram_match:
+            # depth x width
+            size.mem_bits = int(sram_match.group(2)) * int(sram_match.group(3))
+    return sizes
+
+def getTopologicalOrder(sizes):
+    """Module names, parents before children"""
+    parents = {name: 0 for name in sizes}
+    for size in sizes.values():
+        for submodule in size.submodule:
+            if submodule in parents:
+                parents[submodule] += 1
+    order = [name for name, n in parents.items() if n == 0]
+    for name in order:
+        for submodule in sizes[name].submodule:
+            if submodule in parents:
+                parents[submodule] -= 1
+                if parents[submodule] == 0:
+                    order.append(submodule)
+    return order
+
+def analyzeVerilog(filename):
+    sizes = getModuleSizes(filename)
+    order = getTopologicalOrder(sizes)
+    # instance multiplicity from the tops down, flattened sizes from the leaves up
+    for name in order:
+        if sizes[name].instances == 0:
+            sizes[name].instances = 1
+        for submodule, n in sizes[name].submodule.items():
+            if submodule in sizes:
+                sizes[submodule].instances += sizes[name].instances * n
+    for name in reversed(order):
+        size = sizes[name]
+        size.flat_lines, size.flat_reg_bits, size.flat_mem_bits = size.lines, size.reg_bits, size.mem_bits
+        for submodule, n in size.submodule.items():
+            if submodule in sizes:
+                size.flat_lines += n * sizes[submodule].flat_lines
+                size.flat_reg_bits += n * sizes[submodule].flat_reg_bits
+                size.flat_mem_bits += n * sizes[submodule].flat_mem_bits
+    total = sum(size.lines * size.instances for size in sizes.values())
+    len_name = max([len("module")] + [len(name) for name in sizes])
+    columns = ["lines", "reg bits", "mem bits", "instances", "total lines", "%", "flat lines", "flat reg bits", "flat mem bits"]
+    print(("{:<" + str(len_name) + "}").format("module") + "".join("{:>14}".format(c) for c in columns))
+    # sorted by the lines each module adds to the flattened design
+    for size in sorted(sizes.values(), key=lambda s: s.lines * s.instances, reverse=True):
+        values = [size.lines, size.reg_bits, size.mem_bits, size.instances, size.lines * size.instances,
+                  round(size.lines * size.instances * 100.0 / total, 3) if total else 0,
+                  size.flat_lines, size.flat_reg_bits, size.flat_mem_bits]
+        print(("{:<" + str(len_name) + "}").format(size.name) + "".join("{:>14}".format(v) for v in values))
 
 logLevels = ['ALL', 'DEBUG', 'INFO', 'WARN', 'ERROR']
 
-def listToStr(lst):
-    acc = ''
-    for l in lst:
-        acc += '|' + str(l) if acc else str(l)
-    return acc
-
-def lineStrip(line):
-    return line.replace('\n', '')
-
-def getNumLogLines(filename, modules, ll=logLevels):
-    cmd = "grep -E '\[({0}).*\]\[time=.*\] ({1}):' {2} | wc -l".format(
-        listToStr(ll),
-        listToStr(modules),
-        filename
-    )
-    res = os.popen(cmd)
-    return int(lineStrip(res.readline()), 10)
-
-def analyzeLog(filename):
-    cmd = "grep -E '\[time=.*\]' {0} ".format(filename) + " | awk -F '(:)' {'print $1'} | awk  {'print $NF'} | sort | uniq"
-    res = os.popen(cmd)
-    modules = list(map(lineStrip, res.readlines()))
-    mymap = {}
-    for m in modules:
-        mymap[m] = getNumLogLines(filename, [m])
-    printMap(mymap)
+def countLogLines(filename, start=0, end=None):
+    """Count log lines per (module, log level) in one pass
+
+    Only lines starting in [start, end) are counted, so byte ranges of one file
+    can be counted by different processes.
+
+    Returns:
+        dict: (module, level) -> number of lines
+    """
+    counts = {}
+    with open(filename, "rb") as f:
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        if start > 0:
+            # the line across start belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            time = line.find(b"[time=")
+            if time == -1:
+                continue
+            # "[INFO ][time=  100] TOP.SimTop.core.module: message"
+            words = line.split(b":", 1)[0].split()
+            if not words:
+                continue
+            level = line[1:line.find(b"]")].strip() if line.startswith(b"[") else b""
+            key = (words[-1], level)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+def getLogRanges(filename, jobs):
+    size = os.path.getsize(filename)
+    bounds = [size * i // jobs for i in range(jobs + 1)]
+    return [(filename, bounds[i], bounds[i + 1]) for i in range(jobs)]
+
+def analyzeLog(filename, jobs=1):
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            shards = pool.starmap(countLogLines, getLogRanges(filename, jobs))
+    else:
+        shards = [countLogLines(filename)]
+    counts = {}
+    for shard in shards:
+        for key, n in shard.items():
+            counts[key] = counts.get(key, 0) + n
+    modules, levels = {}, {}
+    for (module, level), n in counts.items():
+        module, level = module.decode(errors="replace"), level.decode(errors="replace")
+        # every module is listed, only lines of logLevels are counted
+        modules[module] = modules.get(module, 0) + (n if level in logLevels else 0)
+        levels[level] = levels.get(level, 0) + n
+    if modules:
+        printMap(modules)
+        print()
+        printMap(levels)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verilogFile", help="verilog file path", type=str)
     parser.add_argument("-l", "--logFile", help="log file path", type=str)
+    parser.add_argument("-j", "--jobs", help="number of processes to count the log", type=int, default=1)
     args = parser.parse_args()
 
     if args.verilogFile:
         analyzeVerilog(args.verilogFile)
 
     if args.logFile:
-        analyzeLog(args.logFile)
+        analyzeLog(args.logFile, args.jobs)
 
     if not args.verilogFile and not args.logFile:
         parser.print_help()
@@ -0,0 +1,143 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Resource usage of subprocesses, one JSON object per line
+#
+# CPU time, max RSS and block I/O come from os.wait4, so they include every descendant
+# the command waited for. The peak RSS of the whole process tree (e.g. emu with its
+# LightSSS forks) is sampled with psutil, shared pages are counted once per process.
+#
+#   python3 telemetry.py ci-telemetry.jsonl     # summary per action
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import psutil
+
+
+def wait_rusage(proc, timeout=None):
+    """Wait for a Popen like proc.wait(timeout), and get its resource usage
+
+    It can be called again after a timeout, e.g. to wait for the process to exit after a signal.
+
+    Returns:
+        (return code, resource.struct_rusage)
+    """
+    if not hasattr(proc, "rusage_done"):
+        # an Event instead of Thread.join, which may lose track of the thread when
+        # interrupted by KeyboardInterrupt
+        done = proc.rusage_done = threading.Event()
+
+        def wait():
+            _, status, proc.rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            done.set()
+
+        threading.Thread(target=wait, daemon=True).start()
+    if not proc.rusage_done.wait(timeout):
+        raise subprocess.TimeoutExpired(proc.args, timeout)
+    return proc.returncode, proc.rusage
+
+
+class TreeSampler(object):
+    """Peak of the summed RSS of a process and its descendants, sampled in a thread"""
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Telemetry(object):
+    """Append one record per command to a JSON-lines file, safe for concurrent threads"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def write(self, action, cmd, start, return_code, rusage, peak_rss):
+        record = {
+            "host": socket.gethostname(),
+            "start": start,
+            "action": action,
+            "cmd": cmd,
+            "return_code": return_code,
+            "wall_time": time.time() - start,
+            "user_time": rusage.ru_utime if rusage else None,
+            "sys_time": rusage.ru_stime if rusage else None,
+            # KiB on Linux
+            "max_rss_kb": rusage.ru_maxrss if rusage else None,
+            "peak_tree_rss_kb": peak_rss // 1024,
+            # 512-byte blocks
+            "read_bytes": rusage.ru_inblock * 512 if rusage else None,
+            "write_bytes": rusage.ru_oublock * 512 if rusage else None
+        }
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="summarize telemetry of xiangshan.py actions")
+    parser.add_argument("filename", type=str, help="JSON-lines telemetry file")
+    args = parser.parse_args()
+
+    summary = {}
+    with open(args.filename) as f:
+        for line in f:
+            record = json.loads(line)
+            # emu:<workload> -> emu
+            action = record["action"].split(":")[0]
+            total = summary.setdefault(action, {"count": 0, "wall_time": 0.0, "cpu_time": 0.0, "peak_rss_kb": 0})
+            total["count"] += 1
+            total["wall_time"] += record["wall_time"]
+            total["cpu_time"] += (record["user_time"] or 0) + (record["sys_time"] or 0)
+            total["peak_rss_kb"] = max(total["peak_rss_kb"], record["peak_tree_rss_kb"], record["max_rss_kb"] or 0)
+    print(f"{'action':<16} {'count':>6} {'wall (s)':>12} {'cpu (s)':>12} {'peak rss (MiB)':>16}")
+    for action, total in sorted(summary.items(), key=lambda x: -x[1]["wall_time"]):
+        print(f"{action:<16} {total['count']:>6} {total['wall_time']:>12.1f} {total['cpu_time']:>12.1f} {total['peak_rss_kb'] / 1024:>16.1f}")
@@ -0,0 +1,168 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Top-down comparison of the same checkpoints on two emu builds
+#
+# Only checkpoints present in both directories are compared. Benchmarks and the suite are
+# aggregated with simpoint weights as in simpoint_top_down.py. The CPI change of a benchmark
+# is significant when it is larger than --threshold and consistent over its simpoints:
+# |t| >= --t-value, t being the weighted mean of per-checkpoint log(CPI new / CPI old)
+# over its standard error. Benchmarks with a single checkpoint only use the threshold.
+#
+#   python3 compare_top_down.py old.dir new.dir -o diff.csv
+
+import argparse
+import csv
+import json
+
+import numpy as np
+
+from simpoint_top_down import aggregate, aggregate_suite, flatten, get_breakdown, get_ipc, parse_title
+from top_down import find_csv, read_csv
+
+
+def load_pairs(old_directory, new_directory, json_path=None):
+    """Counters of checkpoints found in both directories
+
+    Returns:
+        (titles, benchmarks, weights, counter names, old counters, new counters):
+        counters are [checkpoint, counter] float arrays (nan if missing)
+    """
+    summary = None
+    if json_path is not None:
+        with open(json_path) as f:
+            summary = json.load(f)
+    old = dict(find_csv(old_directory))
+    new = dict(find_csv(new_directory))
+    titles = sorted(set(old) & set(new))
+    benchmarks, weights = [], []
+    for title in titles:
+        benchmark, point, weight = parse_title(title)
+        if summary is not None:
+            weight = float(summary[benchmark][point])
+        benchmarks.append(benchmark)
+        weights.append(weight)
+    old_counters = [read_csv(old[title]) for title in titles]
+    new_counters = [read_csv(new[title]) for title in titles]
+    names = sorted(set().union(*old_counters, *new_counters))
+
+    def to_array(all_counters):
+        array = np.array([[float(c.get(name, "").strip() or "nan") for name in names] for c in all_counters])
+        return array.reshape(len(titles), len(names))
+
+    return titles, benchmarks, np.array(weights), names, to_array(old_counters), to_array(new_counters)
+
+
+def get_significance(benchmarks, weights, old_ipc, new_ipc):
+    """Consistency of the CPI change of every benchmark over its checkpoints
+
+    Returns:
+        (benchmark names, t values): nan for benchmarks with a single checkpoint
+    """
+    names = sorted(set(benchmarks))
+    result = np.full(len(names), np.nan)
+    log_ratio = np.log(old_ipc / new_ipc)
+    for i, name in enumerate(names):
+        rows = np.array([b == name for b in benchmarks])
+        if rows.sum() < 2:
+            continue
+        w = weights[rows] / weights[rows].sum()
+        mean = (w * log_ratio[rows]).sum()
+        variance = (w * (log_ratio[rows] - mean) ** 2).sum()
+        # effective number of samples of a weighted mean
+        stderr = np.sqrt(variance * (w ** 2).sum())
+        if stderr > 0:
+            result[i] = mean / stderr
+        else:
+            # all checkpoints changed by exactly the same ratio
+            result[i] = np.sign(mean) * np.inf
+    return names, result
+
+
+def get_value(node, index):
+    return float(node.percentage[index]) if np.ndim(node.percentage) else float(node.percentage)
+
+
+def get_movers(old_top, new_top, index, threshold):
+    """Nodes whose share of slots moved by at least threshold, largest first
+
+    Returns:
+        list: (path, old, new, delta)
+    """
+    movers = []
+    for (path, old), (_, new) in zip(flatten(old_top), flatten(new_top)):
+        old_value, new_value = get_value(old, index), get_value(new, index)
+        if abs(new_value - old_value) >= threshold:
+            movers.append((path, old_value, new_value, new_value - old_value))
+    return sorted(movers, key=lambda m: -abs(m[3]))
+
+
+def write_report(output_file, rows, old_ipc, new_ipc, old_top, new_top):
+    with open(output_file, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "node", "old", "new", "delta"])
+        for i, row in enumerate(rows):
+            writer.writerow([row, "ipc", old_ipc[i], new_ipc[i], new_ipc[i] - old_ipc[i]])
+            writer.writerow([row, "cpi", 1.0 / old_ipc[i], 1.0 / new_ipc[i], 1.0 / new_ipc[i] - 1.0 / old_ipc[i]])
+            for path, old, new, delta in get_movers(old_top, new_top, i, 0.0):
+                writer.writerow([row, path, old, new, delta])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare top-down of the same checkpoints on two emu builds")
+    parser.add_argument("old", type=str, help="baseline directory of csv/*.log.csv")
+    parser.add_argument("new", type=str, help="directory of csv/*.log.csv to compare")
+    parser.add_argument("--json", type=str, help="simpoint_summary.json (default: weights in names)")
+    parser.add_argument("--threshold", type=float, default=1.0, help="minimum CPI change in percent (default: 1.0)")
+    parser.add_argument("--t-value", type=float, default=2.0, help="minimum |t| over simpoints (default: 2.0)")
+    parser.add_argument("--node-threshold", type=float, default=1.0, help="minimum node change in percent of slots (default: 1.0)")
+    parser.add_argument("--output", "-o", type=str, help="write all nodes of old and new to this csv")
+    args = parser.parse_args()
+
+    titles, benchmarks, weights, names, old_counters, new_counters = load_pairs(args.old, args.new, args.json)
+    assert titles, f"No common checkpoint in {args.old} and {args.new}"
+    with np.errstate(divide="ignore", invalid="ignore"):
+        benchmark_names, t_values = get_significance(
+            benchmarks, weights, get_ipc(names, old_counters), get_ipc(names, new_counters))
+    all_ipc, all_counters = [], []
+    for counters in (old_counters, new_counters):
+        _, benchmark_counters = aggregate(benchmarks, weights, names, counters)
+        benchmark_ipc = get_ipc(names, benchmark_counters)
+        suite_counters, suite_ipc = aggregate_suite(benchmark_counters, benchmark_ipc)
+        all_ipc.append(np.concatenate([benchmark_ipc, suite_ipc]))
+        all_counters.append(np.concatenate([benchmark_counters, suite_counters]))
+    rows = benchmark_names + ["suite"]
+    old_ipc, new_ipc = all_ipc
+    old_top, new_top = get_breakdown(names, all_counters[0]), get_breakdown(names, all_counters[1])
+
+    cpi_change = (old_ipc / new_ipc - 1) * 100
+    t_values = np.append(t_values, np.nan)
+    print(f"{len(titles)} common checkpoints")
+    print(f"{'name':<24} {'old IPC':>8} {'new IPC':>8} {'CPI':>9} {'t':>8}")
+    significant = []
+    for i, row in enumerate(rows):
+        flag = abs(cpi_change[i]) >= args.threshold and (np.isnan(t_values[i]) or abs(t_values[i]) >= args.t_value)
+        if flag:
+            significant.append(i)
+        print(f"{row:<24} {old_ipc[i]:>8.3f} {new_ipc[i]:>8.3f} {cpi_change[i]:>+8.2f}% {t_values[i]:>8.2f}" + (" *" if flag else ""))
+    for i in significant:
+        movers = get_movers(old_top, new_top, i, args.node_threshold / 100)
+        if movers:
+            print(f"\n{rows[i]}: CPI {cpi_change[i]:+.2f}%")
+            for path, old, new, delta in movers:
+                print(f"  {path:<64} {old * 100:>7.2f}% -> {new * 100:>7.2f}% ({delta * 100:+.2f})")
+    if args.output is not None:
+        write_report(args.output, rows, old_ipc, new_ipc, old_top, new_top)
@@ -0,0 +1,149 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Declarative top-down metric tree, see top_down.toml for the file format
+
+import ast
+import operator
+import os
+
+try:
+    import tomllib
+except ImportError:
+    # python < 3.11, see requirements.txt
+    import tomli as tomllib
+
+
+DEFAULT_TREE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "top_down.toml")
+
+
+class Expression:
+    """A formula over names with + - * / and parentheses
+
+    Values may be floats or numpy arrays, so one evaluation computes many checkpoints.
+    """
+    binary_operators = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv
+    }
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.tree = ast.parse(formula, mode="eval").body
+        self.names = set()
+        self.check(self.tree)
+
+    def check(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in self.binary_operators:
+            self.check(node.left)
+            self.check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            self.check(node.operand)
+        elif isinstance(node, ast.Name):
+            self.names.add(node.id)
+        elif not (isinstance(node, ast.Constant) and isinstance(node.value, (int, float))):
+            raise ValueError(f"Unsupported expression in formula: {self.formula}")
+
+    def evaluate(self, values, node=None):
+        if node is None:
+            node = self.tree
+        if isinstance(node, ast.BinOp):
+            return self.binary_operators[type(node.op)](self.evaluate(values, node.left), self.evaluate(values, node.right))
+        if isinstance(node, ast.UnaryOp):
+            return -self.evaluate(values, node.operand)
+        if isinstance(node, ast.Name):
+            if node.id not in values:
+                raise KeyError(f"{node.id} is not found for formula: {self.formula}")
+            return values[node.id]
+        return node.value
+
+
+class MetricTree:
+    """Counters, constants, derived values and nodes loaded from a toml file
+
+    Args:
+        path (str): toml file, DEFAULT_TREE if None
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = DEFAULT_TREE
+        with open(path, "rb") as f:
+            tree = tomllib.load(f)
+        # csv name -> (module suffix, counter name)
+        self.counters = {}
+        for csv_name, spec in tree.get("counters", {}).items():
+            module_suffix, _, name = spec.rpartition(": ")
+            self.counters[csv_name] = (module_suffix, name)
+        self.constants = tree.get("constants", {})
+        self.expressions = {name: Expression(formula) for name, formula in tree.get("derived", {}).items()}
+        # id -> (name, parent id)
+        self.nodes = {}
+        for node in tree.get("node", []):
+            assert node["id"] not in self.nodes and node["id"] not in self.expressions, f"Duplicated id {node['id']}"
+            self.nodes[node["id"]] = (node["name"], node.get("parent"))
+            self.expressions[node["id"]] = Expression(node["formula"])
+        for node_id, (_, parent) in self.nodes.items():
+            assert parent is None or parent in self.nodes, f"Unknown parent {parent} of {node_id}"
+        self.order = self.get_order()
+
+    def get_order(self):
+        """Evaluation order of derived values and nodes, dependencies first"""
+        order, state = [], {}
+        for name in self.expressions:
+            # iterative DFS, state: 1 visiting, 2 done
+            stack = [(name, False)]
+            while stack:
+                current, expanded = stack.pop()
+                if expanded:
+                    state[current] = 2
+                    order.append(current)
+                    continue
+                if state.get(current) == 2:
+                    continue
+                assert state.get(current) != 1, f"Circular formula at {current}"
+                state[current] = 1
+                stack.append((current, True))
+                for dep in self.expressions[current].names:
+                    if dep in self.expressions and state.get(dep) != 2:
+                        stack.append((dep, False))
+        return order
+
+    def get_counter_specs(self):
+        """[(csv name, module suffix, counter name)] for perf_counter.extract_counters"""
+        return [(csv_name, module_suffix, name) for csv_name, (module_suffix, name) in self.counters.items()]
+
+    def evaluate(self, counters):
+        """Evaluate all derived values and nodes
+
+        Args:
+            counters (dict): counter name -> value string, float or numpy array
+
+        Returns:
+            dict: node id -> value
+        """
+        values = dict(self.constants)
+        for name, value in counters.items():
+            if isinstance(value, str):
+                # counter not found in the log, only an error if a formula uses it
+                if not value.strip():
+                    continue
+                value = float(value)
+            values[name] = value
+        for name in self.order:
+            values[name] = self.expressions[name].evaluate(values)
+        return {node_id: values[node_id] for node_id in self.nodes}
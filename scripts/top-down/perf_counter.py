@@ -0,0 +1,99 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Single-pass replacement of top-down.sh: python3 perf_counter.py <log> writes <log>.csv
+
+import argparse
+from functools import lru_cache
+
+from metric_tree import MetricTree
+
+
+@lru_cache(maxsize=None)
+def get_top_down_counters():
+    """(csv name, module suffix, counter name) from [counters] in top_down.toml
+
+    An empty module suffix matches any module, like grep ": name," does.
+    The tree is parsed on first use, not when this module is imported.
+    """
+    return tuple(MetricTree().get_counter_specs())
+
+
+def parse_perf_line(line):
+    """Split one XSPerf line
+
+    Args:
+        line (str): e.g. "[PERF ][time=  100] TOP.SimTop.core.ctrlBlock.rob: clock_cycle,   100"
+
+    Returns:
+        (module, counter name, value string), or None if it is not a perf counter line
+    """
+    colon = line.find(": ")
+    if colon == -1:
+        return None
+    comma = line.find(",", colon)
+    if comma == -1:
+        return None
+    module = line[line.rfind(" ", 0, colon) + 1:colon]
+    return module, line[colon + 2:comma], line[comma + 1:].strip()
+
+
+def extract_counters(filename, counters=None):
+    """Extract counters from an emu log in one pass
+
+    Every line is split once and looked up by counter name in a dictionary.
+    As with grep in top-down.sh, the last matching line wins.
+
+    Returns:
+        dict: csv name -> value string ("" if the counter is not found)
+    """
+    if counters is None:
+        counters = get_top_down_counters()
+    lookup = {}
+    for csv_name, module_suffix, name in counters:
+        lookup.setdefault(name, []).append((module_suffix, csv_name))
+    values = {csv_name: "" for csv_name, _, _ in counters}
+    with open(filename, errors="replace", buffering=1 << 20) as f:
+        for line in f:
+            perf = parse_perf_line(line)
+            if perf is None:
+                continue
+            module, name, value = perf
+            for module_suffix, csv_name in lookup.get(name, ()):
+                if module.endswith(module_suffix):
+                    values[csv_name] = value
+    return values
+
+
+def write_csv(values, filename):
+    """Write counters in the same layout as top-down.sh"""
+    with open(filename, "w") as f:
+        for csv_name, value in values.items():
+            f.write(f"{csv_name + ',':<33}{value}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extract top-down counters from an emu log")
+    parser.add_argument("filename", type=str, help="emu log, counters are written to <filename>.csv")
+    parser.add_argument("--debug", action="store_true", help="print the csv")
+    parser.add_argument("--tree", type=str, help="metric tree definition (default: top_down.toml)")
+    args = parser.parse_args()
+
+    values = extract_counters(args.filename, MetricTree(args.tree).get_counter_specs())
+    write_csv(values, args.filename + ".csv")
+    if args.debug:
+        with open(args.filename + ".csv") as f:
+            print(f.read(), end="")
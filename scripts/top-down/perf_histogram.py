@@ -0,0 +1,209 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Distributions of XSPerfHistogram counters
+#
+# XSPerfHistogram("name", value, enable, start, stop, step) prints one counter per bucket,
+# "name_<bin start>_<bin stop>" for values in [bin start, bin stop). Several calls with the
+# same name (e.g. miss_penalty 0-20 step 1 and 20-100 step 10) are one histogram. Values
+# out of [start, stop) may be counted in the first and last buckets, so percentiles
+# in the edge buckets are bounds, not exact.
+#
+#   python3 perf_histogram.py store.npz --filter "*miss_penalty*" -o hist.csv --html hist.html
+#   python3 perf_histogram.py emu.dir/*.log --top-down --html hist.html
+
+import argparse
+import fnmatch
+import os
+import re
+
+import numpy as np
+from pyecharts import options as opts
+from pyecharts.charts import Bar, Page
+
+from perf_counter import get_top_down_counters
+from perf_store import PerfStore
+from simpoint_top_down import get_breakdown
+
+
+BUCKET_PATTERN = re.compile(r"^(?P<key>.*)_(?P<start>\d+)_(?P<stop>\d+)$")
+
+
+class Histogram:
+    """One XSPerfHistogram of many runs
+
+    Args:
+        key (str): "module: name" without the bucket suffix
+        starts (np.array): first value of every bucket
+        stops (np.array): last value + 1 of every bucket
+        counts (np.array): int64 [run, bucket]
+    """
+    def __init__(self, key, starts, stops, counts):
+        self.key = key
+        self.starts = starts
+        self.stops = stops
+        self.counts = counts
+
+    def samples(self):
+        return self.counts.sum(axis=1)
+
+    def mean(self):
+        """Mean of every run, each bucket counts as its middle value"""
+        middles = (self.starts + self.stops - 1) / 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.counts @ middles / self.samples()
+
+    def percentile(self, q):
+        """q-th percentile of every run, interpolated linearly within the bucket
+
+        Args:
+            q (float): 0 to 100
+
+        Returns:
+            np.array: float [run], nan for runs without samples
+        """
+        total = self.samples()
+        cumulative = np.cumsum(self.counts, axis=1)
+        target = total * q / 100
+        # the first bucket whose cumulative count reaches the target
+        bucket = np.argmax(cumulative >= target[:, None], axis=1)
+        rows = np.arange(len(total))
+        below = cumulative[rows, bucket] - self.counts[rows, bucket]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.clip((target - below) / self.counts[rows, bucket], 0, 1)
+        result = self.starts[bucket] + fraction * (self.stops[bucket] - self.starts[bucket])
+        return np.where(total > 0, result, np.nan)
+
+    def distribution(self):
+        """Fraction of samples in every bucket, float [run, bucket]"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.counts / self.samples()[:, None]
+
+
+def find_histograms(store, pattern="*"):
+    """Group bucket counters of a store into histograms
+
+    Args:
+        store (PerfStore): counters of all runs
+        pattern (str): glob pattern of histogram keys "module: name"
+
+    Returns:
+        list: Histogram sorted by key
+    """
+    buckets = {}
+    for column, key in enumerate(store.keys):
+        match = BUCKET_PATTERN.match(key)
+        if match is None or not fnmatch.fnmatchcase(match["key"], pattern):
+            continue
+        start, stop = int(match["start"]), int(match["stop"])
+        if stop <= start:
+            continue
+        buckets.setdefault(match["key"], []).append((start, stop, column))
+    histograms = []
+    for key, bins in sorted(buckets.items()):
+        bins.sort()
+        columns = [column for _, _, column in bins]
+        counts = np.where(store.valid[:, columns], store.values[:, columns], 0)
+        histograms.append(Histogram(key, np.array([b[0] for b in bins]), np.array([b[1] for b in bins]), counts))
+    return histograms
+
+
+def load_store(inputs, jobs):
+    """A .npz store, or a new store of emu logs"""
+    if len(inputs) == 1 and inputs[0].endswith(".npz"):
+        return PerfStore.load(inputs[0])
+    return PerfStore.from_logs(inputs, jobs)
+
+
+def write_report(output_file, runs, histograms, percentiles):
+    with open(output_file, "w") as f:
+        f.write(",".join(["histogram", "run", "samples", "mean"] + [f"p{q:g}" for q in percentiles]) + "\n")
+        for histogram in histograms:
+            columns = [histogram.samples(), histogram.mean()] + [histogram.percentile(q) for q in percentiles]
+            for i, run in enumerate(runs):
+                f.write(",".join([histogram.key, run] + [str(c[i]) for c in columns]) + "\n")
+
+
+def print_report(runs, histograms, percentiles):
+    for histogram in histograms:
+        print(histogram.key)
+        print(f"  {'run':<32} {'samples':>12} {'mean':>10} " + " ".join(f"{'p' + format(q, 'g'):>10}" for q in percentiles))
+        columns = [histogram.percentile(q) for q in percentiles]
+        samples, mean = histogram.samples(), histogram.mean()
+        for i, run in enumerate(runs):
+            print(f"  {run:<32} {samples[i]:>12} {mean[i]:>10.2f} " + " ".join(f"{c[i]:>10.2f}" for c in columns))
+
+
+def draw_histogram(runs, histogram):
+    """Bar chart of the bucket distributions, one series per run"""
+    labels = [f"[{start}, {stop})" for start, stop in zip(histogram.starts, histogram.stops)]
+    bar = (
+        Bar(init_opts=opts.InitOpts(width="1600px", height="600px"))
+        .add_xaxis(labels)
+        .set_global_opts(
+            title_opts=opts.TitleOpts(title=histogram.key),
+            tooltip_opts=opts.TooltipOpts(trigger="axis"),
+            yaxis_opts=opts.AxisOpts(name="samples (%)"),
+            legend_opts=opts.LegendOpts(type_="scroll", pos_top="bottom")))
+    distribution = np.nan_to_num(histogram.distribution())
+    for i, run in enumerate(runs):
+        bar.add_yaxis(run, np.round(distribution[i] * 100, 2).tolist(), label_opts=opts.LabelOpts(is_show=False))
+    return bar
+
+
+def draw_top_down(runs, top):
+    """Stacked bars of the level 1 top-down nodes, one bar per run"""
+    bar = (
+        Bar(init_opts=opts.InitOpts(width="1600px", height="600px"))
+        .add_xaxis(runs)
+        .set_global_opts(
+            title_opts=opts.TitleOpts(title="Top-Down"),
+            tooltip_opts=opts.TooltipOpts(trigger="axis"),
+            yaxis_opts=opts.AxisOpts(name="slots (%)", max_=100),
+            xaxis_opts=opts.AxisOpts(axislabel_opts=opts.LabelOpts(rotate=30))))
+    for node in top.down.values():
+        percentage = np.broadcast_to(node.percentage, (len(runs),))
+        bar.add_yaxis(node.name, np.round(np.nan_to_num(percentage) * 100, 2).tolist(), stack="top-down",
+                      label_opts=opts.LabelOpts(is_show=False))
+    return bar
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="distributions of XSPerfHistogram counters")
+    parser.add_argument("inputs", nargs="+", type=str, help="a perf_store.py .npz store, or emu logs")
+    parser.add_argument("--filter", type=str, default="*", help="glob pattern of histograms, 'module: name'")
+    parser.add_argument("--percentiles", "-p", nargs="+", type=float, default=[50, 90, 99], help="percentiles to report")
+    parser.add_argument("--output", "-o", type=str, help="write statistics to this csv")
+    parser.add_argument("--html", type=str, help="draw distributions to this html")
+    parser.add_argument("--top-down", action="store_true", help="draw top-down of every run before the histograms")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="number of processes to parse logs")
+    args = parser.parse_args()
+
+    store = load_store(args.inputs, args.jobs)
+    histograms = find_histograms(store, args.filter)
+    print_report(store.runs, histograms, args.percentiles)
+    if args.output is not None:
+        write_report(args.output, store.runs, histograms, args.percentiles)
+    if args.html is not None:
+        page = Page(page_title="perf histograms", layout=Page.SimplePageLayout)
+        if args.top_down:
+            arrays = store.extract_arrays(get_top_down_counters())
+            names = list(arrays)
+            counters = np.stack([arrays[name] for name in names], axis=1).reshape(len(store.runs), len(names))
+            page.add(draw_top_down(store.runs, get_breakdown(names, counters)))
+        for histogram in histograms:
+            page.add(draw_histogram(store.runs, histogram))
+        page.render(args.html)
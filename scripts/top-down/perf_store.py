@@ -0,0 +1,246 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Columnar store of XSPerf counters
+#
+# Every "[PERF ][time=...] module: counter, value" line of many emu logs is kept in one
+# .npz file: a dictionary of counter keys ("module: counter"), the run names, and an
+# int64 [run, counter] array. Analyses over hundreds of runs load it in milliseconds
+# instead of reparsing the raw logs.
+#
+#   python3 perf_store.py build -o store.npz emu.dir/*.log
+#   python3 perf_store.py query store.npz "*ctrlBlock.rob: clock_cycle" "*: commitInstr"
+#   python3 perf_store.py csv store.npz out.dir   # then python3 top_down.py --batch out.dir
+
+import argparse
+import fnmatch
+import os
+import re
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from perf_counter import get_top_down_counters, parse_perf_line, write_csv
+
+
+def get_run_name(filename):
+    name = os.path.basename(filename)
+    return name[:-len(".log")] if name.endswith(".log") else name
+
+
+def parse_log(filename):
+    """All perf counters of one emu log, the last dump of each counter wins
+
+    Returns:
+        dict: "module: counter" -> int
+    """
+    counters = {}
+    with open(filename, errors="replace", buffering=1 << 20) as f:
+        for line in f:
+            if not line.startswith("[PERF ]"):
+                continue
+            perf = parse_perf_line(line)
+            if perf is None:
+                continue
+            module, name, value = perf
+            try:
+                counters[module + ": " + name] = int(value)
+            except ValueError:
+                continue
+    return counters
+
+
+class PerfStore:
+    """Perf counters of many runs
+
+    Args:
+        runs (list): run names
+        keys (list): counter keys, "module: counter"
+        values (np.array): int64 [run, counter]
+        valid (np.array): bool [run, counter], False if the run does not have the counter
+    """
+    def __init__(self, runs, keys, values, valid):
+        self.runs = list(runs)
+        self.keys = list(keys)
+        self.values = values
+        self.valid = valid
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        self.run_index = {run: i for i, run in enumerate(self.runs)}
+
+    @classmethod
+    def from_counters(cls, runs, all_counters):
+        keys = sorted(set().union(*all_counters)) if all_counters else []
+        key_index = {key: i for i, key in enumerate(keys)}
+        values = np.zeros((len(runs), len(keys)), dtype=np.int64)
+        valid = np.zeros((len(runs), len(keys)), dtype=bool)
+        for i, counters in enumerate(all_counters):
+            columns = np.fromiter((key_index[key] for key in counters), dtype=np.int64, count=len(counters))
+            values[i, columns] = np.fromiter(counters.values(), dtype=np.int64, count=len(counters))
+            valid[i, columns] = True
+        return cls(runs, keys, values, valid)
+
+    @classmethod
+    def from_logs(cls, filenames, jobs=1):
+        """Parse emu logs, one run per log, in a process pool"""
+        with Pool(jobs) as pool:
+            all_counters = pool.map(parse_log, filenames)
+        return cls.from_counters(list(map(get_run_name, filenames)), all_counters)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data["runs"].tolist(), data["keys"].tolist(), data["values"], data["valid"])
+
+    def save(self, filename):
+        np.savez_compressed(filename, runs=np.array(self.runs, dtype=str), keys=np.array(self.keys, dtype=str),
+                            values=self.values, valid=self.valid)
+
+    def merge(self, other):
+        """A new store with the runs of both stores, runs of other replace runs with the same name"""
+        runs = [run for run in self.runs if run not in other.run_index] + other.runs
+        all_counters = [self.get_run(run) for run in self.runs if run not in other.run_index] + \
+                       [other.get_run(run) for run in other.runs]
+        return PerfStore.from_counters(runs, all_counters)
+
+    def get_run(self, run):
+        """dict: "module: counter" -> int of one run"""
+        i = self.run_index[run]
+        columns = np.flatnonzero(self.valid[i])
+        return dict(zip((self.keys[c] for c in columns), self.values[i, columns].tolist()))
+
+    def match(self, pattern):
+        """Column indices of keys matching a glob pattern"""
+        if pattern in self.key_index:
+            return [self.key_index[pattern]]
+        regex = re.compile(fnmatch.translate(pattern))
+        return [i for i, key in enumerate(self.keys) if regex.match(key)]
+
+    def query(self, *patterns):
+        """Counters whose keys match any glob pattern
+
+        Returns:
+            (keys, values, valid): matched keys and their [run, key] columns
+        """
+        columns = sorted(set(c for pattern in patterns for c in self.match(pattern)))
+        return [self.keys[c] for c in columns], self.values[:, columns], self.valid[:, columns]
+
+    def sum(self, pattern):
+        """Sum of all counters matching a glob pattern, e.g. over all cores
+
+        Returns:
+            np.array: int64 [run]
+        """
+        _, values, valid = self.query(pattern)
+        return np.where(valid, values, 0).sum(axis=1)
+
+    def get_spec_columns(self, counter_specs):
+        """All matching columns of every (csv name, module suffix, counter name)
+
+        Returns:
+            dict: csv name -> matched columns in sorted key order
+        """
+        columns = {}
+        for csv_name, module_suffix, name in counter_specs:
+            columns[csv_name] = self.match("*" + module_suffix + ": " + name)
+        return columns
+
+    def select_spec_values(self, matched):
+        """Value of one counter spec in every run
+
+        Like grep in top-down.sh, only one value is kept when several modules match
+        (e.g. multiple cores): the last matched key that the run has, chosen per run.
+
+        Returns:
+            (values, valid): int64 [run] and bool [run]
+        """
+        values = np.zeros(len(self.runs), dtype=np.int64)
+        valid = np.zeros(len(self.runs), dtype=bool)
+        for column in matched:
+            values = np.where(self.valid[:, column], self.values[:, column], values)
+            valid |= self.valid[:, column]
+        return values, valid
+
+    def extract_arrays(self, counter_specs):
+        """Counters of all runs as arrays, for vectorized top-down
+
+        Args:
+            counter_specs (list): [(csv name, module suffix, counter name)]
+
+        Returns:
+            dict: csv name -> float [run] (nan if the run does not have it)
+        """
+        arrays = {}
+        for csv_name, matched in self.get_spec_columns(counter_specs).items():
+            values, valid = self.select_spec_values(matched)
+            arrays[csv_name] = np.where(valid, values, np.nan)
+        return arrays
+
+    def extract(self, counter_specs):
+        """Counters in the perf_counter.extract_counters format for every run
+
+        Args:
+            counter_specs (list): [(csv name, module suffix, counter name)]
+
+        Returns:
+            list: one dict csv name -> value string per run
+        """
+        selected = {}
+        for csv_name, matched in self.get_spec_columns(counter_specs).items():
+            selected[csv_name] = self.select_spec_values(matched)
+        result = []
+        for i in range(len(self.runs)):
+            values = {}
+            for csv_name, (column_values, valid) in selected.items():
+                values[csv_name] = str(column_values[i]) if valid[i] else ""
+            result.append(values)
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="columnar store of XSPerf counters")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="convert emu logs into a store")
+    build.add_argument("logs", nargs="+", type=str, help="emu logs, one run per log")
+    build.add_argument("--output", "-o", type=str, required=True, help="store file (.npz)")
+    build.add_argument("--append", action="store_true", help="add runs to an existing store")
+    build.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="number of processes")
+    query = subparsers.add_parser("query", help="print counters matching glob patterns as csv")
+    query.add_argument("store", type=str, help="store file (.npz)")
+    query.add_argument("patterns", nargs="+", type=str, help="glob patterns of 'module: counter'")
+    to_csv = subparsers.add_parser("csv", help="write top-down csv/<run>.log.csv of every run")
+    to_csv.add_argument("store", type=str, help="store file (.npz)")
+    to_csv.add_argument("directory", type=str, help="output directory, csv files go to <directory>/csv")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        store = PerfStore.from_logs(args.logs, args.jobs)
+        if args.append and os.path.isfile(args.output):
+            store = PerfStore.load(args.output).merge(store)
+        store.save(args.output)
+        print(f"{len(store.runs)} runs, {len(store.keys)} counters saved to {args.output}")
+    elif args.command == "csv":
+        store = PerfStore.load(args.store)
+        os.makedirs(os.path.join(args.directory, "csv"), exist_ok=True)
+        for run, values in zip(store.runs, store.extract(get_top_down_counters())):
+            write_csv(values, os.path.join(args.directory, "csv", run + ".log.csv"))
+    else:
+        store = PerfStore.load(args.store)
+        keys, values, valid = store.query(*args.patterns)
+        sys.stdout.write(",".join(["run"] + keys) + "\n")
+        for i, run in enumerate(store.runs):
+            row = [str(values[i, j]) if valid[i, j] else "" for j in range(len(keys))]
+            sys.stdout.write(",".join([run] + row) + "\n")
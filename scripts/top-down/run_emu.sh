@@ -33,7 +33,7 @@ for file in $(cat file.f); do
     ./xsrun ${dir}/emus/${emu} -W 20000000 -I 40000000 -i ${spec_dir}/${file}/0/${gz} -s 7541 --diff=${NOOP_HOME}/ready-to-run/riscv64-nemu-interpreter-so 2>${dir}/${spec_name}/${emu}.dir/${file}.log
     if [ $? -eq 0 ]; then
       sed "1,$(($(cat ${dir}/${spec_name}/${emu}.dir/${file}.log | wc -l) / 2))d" ${dir}/${spec_name}/${emu}.dir/${file}.log >${dir}/${spec_name}/${emu}.dir/csv/${file}.log
-      ${dir}/top-down.sh ${dir}/${spec_name}/${emu}.dir/csv/${file}.log
+      $python ${dir}/perf_counter.py ${dir}/${spec_name}/${emu}.dir/csv/${file}.log
       rm ${dir}/${spec_name}/${emu}.dir/csv/${file}.log
       $python ${dir}/top_down.py ${file} ${dir}/${spec_name}/${emu}.dir ${emu} # python ./top_down.py title dir suffix
     fi
@@ -0,0 +1,182 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Simpoint-weighted top-down of benchmarks and suites
+#
+# Checkpoints are named <benchmark>_<point>_<weight> as in file.f and load_all_gcpt.
+# Counters of every checkpoint are normalized per instruction and combined with the
+# simpoint weights (normalized within each benchmark), so a benchmark looks like one
+# long run of all its simpoints. A suite gives every benchmark the same number of
+# instructions, and its IPC is the geometric mean of the benchmark IPCs.
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+from pyecharts.charts import Page
+
+from top_down import compute_top_down, draw_sunburst, find_csv, read_csv
+
+
+def parse_title(title):
+    """Split <benchmark>_<point>_<weight>, the benchmark name may contain '_'"""
+    benchmark, point, weight = title.rsplit("_", 2)
+    return benchmark, point, float(weight)
+
+
+def load_checkpoints(directory, json_path=None):
+    """Load counters of all checkpoints under directory
+
+    Args:
+        directory (String): directory to search csv/*.log.csv
+        json_path (String): simpoint_summary.json, overrides the weights in the names
+
+    Returns:
+        (benchmarks, weights, counter names, counters): benchmark name and weight of
+        every checkpoint, and a [checkpoint, counter] float array (nan if missing)
+    """
+    summary = None
+    if json_path is not None:
+        with open(json_path) as f:
+            summary = json.load(f)
+    benchmarks, weights, all_counters = [], [], []
+    for title, path in find_csv(directory):
+        benchmark, point, weight = parse_title(title)
+        if summary is not None:
+            weight = float(summary[benchmark][point])
+        benchmarks.append(benchmark)
+        weights.append(weight)
+        all_counters.append(read_csv(path))
+    names = sorted(set().union(*all_counters)) if all_counters else []
+    counters = np.array([[float(c.get(name, "").strip() or "nan") for name in names] for c in all_counters])
+    return benchmarks, np.array(weights), names, counters.reshape(len(all_counters), len(names))
+
+
+def aggregate(groups, weights, names, counters):
+    """Weighted per-instruction counters of every group
+
+    Args:
+        groups (list): group of every row
+        weights (np.array): weight of every row, normalized within each group here
+        names (list): counter names
+        counters (np.array): [row, counter]
+
+    Returns:
+        (group names, [group, counter] array)
+    """
+    group_names = sorted(set(groups))
+    group_index = np.array([group_names.index(g) for g in groups])
+    group_weight = np.bincount(group_index, weights=weights, minlength=len(group_names))
+    normalized_weights = weights / group_weight[group_index]
+    # commitInstr is not in csv extracted by old scripts, fall back to committed uops
+    instrs_name = "total_instrs" if "total_instrs" in names else "slots_retired"
+    instrs = counters[:, names.index(instrs_name)]
+    per_instr = counters / instrs[:, None] * normalized_weights[:, None]
+    result = np.zeros((len(group_names), len(names)))
+    np.add.at(result, group_index, per_instr)
+    return group_names, result
+
+
+def get_ipc(names, counters):
+    instrs_name = "total_instrs" if "total_instrs" in names else "slots_retired"
+    return counters[:, names.index(instrs_name)] / counters[:, names.index("total_cycles")]
+
+
+def aggregate_suite(benchmark_counters, benchmark_ipc):
+    """Every benchmark counts the same in the suite
+
+    Returns:
+        ([1, counter] array, [1] IPC): IPC is the geometric mean of the benchmarks
+    """
+    return benchmark_counters.mean(axis=0, keepdims=True), np.exp(np.log(benchmark_ipc).mean(keepdims=True))
+
+
+def get_breakdown(names, counters, tree=None):
+    """Vectorized top-down over all rows
+
+    Args:
+        names (list): counter names
+        counters (np.array): [row, counter]
+        tree (MetricTree): metric tree definition, top_down.toml if None
+
+    Returns:
+        TopDown: every node holds one percentage per row
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return compute_top_down(dict(zip(names, counters.T)), tree)
+
+
+def flatten(top, prefix=""):
+    """All (path, node) of a tree, parents before children"""
+    path = prefix + top.name.replace("\n", " ")
+    nodes = [(path, top)]
+    for down in top.down.values():
+        nodes += flatten(down, path + "/")
+    return nodes
+
+
+def write_report(output_file, rows, ipc, top):
+    nodes = flatten(top)
+    with open(output_file, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "ipc", "cpi"] + [path for path, _ in nodes])
+        for i, row in enumerate(rows):
+            writer.writerow([row, ipc[i], 1.0 / ipc[i]] + [float(np.broadcast_to(node.percentage, ipc.shape)[i]) for _, node in nodes])
+
+
+def print_report(rows, ipc, top):
+    level_1 = list(top.down.values())
+    print(f"{'name':<24} {'IPC':>6} {'CPI':>6} " + " ".join(f"{node.name:>16}" for node in level_1))
+    for i, row in enumerate(rows):
+        print(f"{row:<24} {ipc[i]:>6.3f} {1.0 / ipc[i]:>6.3f} " + " ".join(f"{node.percentage[i] * 100:>15.2f}%" for node in level_1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simpoint-weighted top-down of benchmarks and suites")
+    parser.add_argument("directory", nargs="+", type=str, help="one directory of csv/*.log.csv per suite")
+    parser.add_argument("--json", nargs="*", type=str, help="simpoint_summary.json of every suite (default: weights in names)")
+    parser.add_argument("--output", "-o", type=str, help="write all nodes of benchmarks and suites to this csv")
+    parser.add_argument("--html", type=str, help="draw benchmarks and suites to this html")
+    args = parser.parse_args()
+
+    assert args.json is None or len(args.json) == len(args.directory), "Expect one json per directory"
+
+    all_rows, all_ipc, all_counters = [], [], []
+    for i, directory in enumerate(args.directory):
+        suite = os.path.basename(os.path.realpath(directory))
+        benchmarks, weights, names, counters = load_checkpoints(directory, args.json[i] if args.json else None)
+        if i == 0:
+            all_names = names
+        assert names == all_names, f"{directory} has different counters"
+        benchmark_names, benchmark_counters = aggregate(benchmarks, weights, names, counters)
+        benchmark_ipc = get_ipc(names, benchmark_counters)
+        suite_counters, suite_ipc = aggregate_suite(benchmark_counters, benchmark_ipc)
+        all_rows += [f"{suite}/{b}" for b in benchmark_names] + [suite]
+        all_ipc.append(np.concatenate([benchmark_ipc, suite_ipc]))
+        all_counters.append(np.concatenate([benchmark_counters, suite_counters]))
+
+    ipc = np.concatenate(all_ipc)
+    top = get_breakdown(all_names, np.concatenate(all_counters))
+    print_report(all_rows, ipc, top)
+    if args.output is not None:
+        write_report(args.output, all_rows, ipc, top)
+    if args.html is not None:
+        page = Page(page_title="simpoint top-down", layout=Page.SimplePageLayout)
+        for i, row in enumerate(all_rows):
+            page.add(draw_sunburst(top.select(i), f"{row} IPC {ipc[i]:.3f}"))
+        page.render(args.html)
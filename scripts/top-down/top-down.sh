@@ -73,6 +73,8 @@ ldReplay_bubble_cycles=${tmp##* }
 
 tmp=$(grep "core.ctrlBlock.decode: ifu2id_allNO_cycle," $filename)
 ifu2id_allNO_cycle=${tmp##* }
+tmp=$(grep "core.ctrlBlock.rob: commitInstr," $filename)
+total_instrs=${tmp##* }
 
 echo "total_cycles,                    $total_cycles"                     >$filename.csv
 echo "fetch_bubbles,                   $fetch_bubbles"                   >>$filename.csv
@@ -108,5 +110,6 @@ echo "branch_resteers_cycles,          $branch_resteers_cycles"          >>$file
 echo "robFlush_bubble_cycles,          $robFlush_bubble_cycles"          >>$filename.csv
 echo "ldReplay_bubble_cycles,          $ldReplay_bubble_cycles"          >>$filename.csv
 echo "ifu2id_allNO_cycle,              $ifu2id_allNO_cycle"              >>$filename.csv
+echo "total_instrs,                    $total_instrs"                    >>$filename.csv
 
 [ -z "$debug" ] || cat $filename.csv
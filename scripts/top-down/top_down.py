@@ -1,11 +1,21 @@
+import argparse
 import csv
+import glob
+import os
 import sys
+from functools import partial
+from multiprocessing import Pool
 from pyecharts.charts import Page, Sunburst
 from pyecharts import options as opts
 
+from metric_tree import MetricTree
+
 
 class TopDown:
     """TopDown node"""
+    # let numpy arrays defer to the reflected operators below
+    __array_ufunc__ = None
+
     def __init__(self, name, percentage):
         self.name = name
         if isinstance(percentage, TopDown):
@@ -71,6 +81,23 @@ class TopDown:
         self.down[name].level = self.level + 1
         return self.down[name]
 
+    def select(self, index):
+        """Select one element of a tree computed from counter arrays
+
+        Args:
+            index (int): element index
+
+        Returns:
+            TopDown: a copy of this subtree with scalar percentages
+        """
+        percentage = self.percentage[index] if hasattr(self.percentage, "__getitem__") else self.percentage
+        node = TopDown(self.name, float(percentage))
+        node.level = self.level
+        for name, down in self.down.items():
+            node.down[name] = down.select(index)
+            node.down[name].top = node
+        return node
+
     def draw(self):
         """Draw the TopDown sunburst chart
 
@@ -87,86 +114,66 @@ class TopDown:
         return items
 
 
-def process_one(path, head):
-    """Process one chart
+def read_csv(path):
+    """Read the counters of one checkpoint
 
     Args:
         path (String): csv path
-        head (String): chart head
 
     Returns:
-        Sunburst chart
+        dict: counter name -> value string
     """
     with open(path, encoding='UTF-8') as file:
-        csv_file = dict(csv.reader(file))
-
-    def use(name):
-        return float(csv_file[name])
-
-    csv_file['total_slots'] = use('total_cycles') * 6
-    csv_file['ifu2id_allNO_slots'] = use('ifu2id_allNO_cycle') * 6
-    csv_file['ifu2id_hvButNotFull_slots'] = use('fetch_bubbles') - use('ifu2id_allNO_slots')
-
-    stall_cycles_core = use('stall_cycle_fp') + use('stall_cycle_int') + use('stall_cycle_rob') + use('stall_cycle_int_dq') + use('stall_cycle_fp_dq') + use('ls_dq_bound_cycles')
-
-    top = TopDown("Top", 1.0)
-
-# top
-    frontend_bound = top.add_down("Frontend Bound", use('decode_bubbles') / use('total_slots'))
-    bad_speculation = top.add_down("Bad Speculation", (use('slots_issued') - use('slots_retired') + use('recovery_bubbles')) / use('total_slots'))
-    retiring = top.add_down("Retiring", use('slots_retired') / use('total_slots'))
-    backend_bound = top.add_down("Backend Bound", top - frontend_bound - bad_speculation - retiring)
-
-#top->frontend_bound
-    fetch_latency = frontend_bound.add_down("Fetch Latency", use('fetch_bubbles') / use('total_slots'))
-    fetch_bandwidth = frontend_bound.add_down("Fetch Bandwidth", frontend_bound - fetch_latency)
-
-# top->frontend_bound->fetch_latency
-    itlb_miss = fetch_latency.add_down("iTLB Miss", use('itlb_miss_cycles') / use('total_cycles'))
-    icache_miss = fetch_latency.add_down("iCache Miss", use('icache_miss_cycles') / use('total_cycles'))
-    stage2_redirect_cycles = fetch_latency.add_down("Stage2 Redirect", use('stage2_redirect_cycles') / use('total_cycles'))
-    if2id_bandwidth = fetch_latency.add_down("IF2ID Bandwidth", use('ifu2id_hvButNotFull_slots') / use('total_slots'))
-    fetch_latency_others = fetch_latency.add_down("Fetch Latency Others", fetch_latency - itlb_miss - icache_miss - stage2_redirect_cycles - if2id_bandwidth)
-
-# top->frontend_bound->fetch_latency->stage2_redirect_cycles
-    branch_resteers = stage2_redirect_cycles.add_down("Branch Resteers", use('branch_resteers_cycles') / use('total_cycles'))
-    robFlush_bubble = stage2_redirect_cycles.add_down("RobFlush Bubble", use('robFlush_bubble_cycles') / use('total_cycles'))
-    ldReplay_bubble = stage2_redirect_cycles.add_down("LdReplay Bubble", use('ldReplay_bubble_cycles') / use('total_cycles'))
-
-# top->bad_speculation
-    branch_mispredicts = bad_speculation.add_down("Branch Mispredicts", bad_speculation)
-
-# top->backend_bound
-    memory_bound = backend_bound.add_down("Memory Bound", backend_bound * (use('store_bound_cycles') + use('load_bound_cycles')) / (
-        stall_cycles_core + use('store_bound_cycles') + use('load_bound_cycles')))
-    core_bound = backend_bound.add_down("Core Bound", backend_bound - memory_bound)
-
-# top->backend_bound->memory_bound
-    stores_bound = memory_bound.add_down("Stores Bound", use('store_bound_cycles') / use('total_cycles'))
-    loads_bound = memory_bound.add_down("Loads Bound", use('load_bound_cycles') / use('total_cycles'))
-
-# top->backend_bound->core_bound
-    integer_dq = core_bound.add_down("Integer DQ", core_bound * use('stall_cycle_int_dq') / stall_cycles_core)
-    floatpoint_dq = core_bound.add_down("Floatpoint DQ", core_bound * use('stall_cycle_fp_dq') / stall_cycles_core)
-    rob = core_bound.add_down("ROB", core_bound * use('stall_cycle_rob') / stall_cycles_core)
-    integer_prf = core_bound.add_down("Integer PRF", core_bound * use('stall_cycle_int') / stall_cycles_core)
-    floatpoint_prf = core_bound.add_down("Floatpoint PRF", core_bound * use('stall_cycle_fp') / stall_cycles_core)
-    lsu_ports = core_bound.add_down("LSU Ports", core_bound * use('ls_dq_bound_cycles') / stall_cycles_core)
-
-# top->backend_bound->memory_bound->loads_bound
-    l1d_loads_bound = loads_bound.add_down("L1D Loads", use('l1d_loads_bound_cycles') / use('total_cycles'))
-    l2_loads_bound = loads_bound.add_down("L2 Loads", use('l2_loads_bound_cycles') / use('total_cycles'))
-    l3_loads_bound = loads_bound.add_down("L3 Loads", use('l3_loads_bound_cycles') / use('total_cycles'))
-    ddr_loads_bound = loads_bound.add_down("DDR Loads", use('ddr_loads_bound_cycles') / use('total_cycles'))
-
-# top->backend_bound->memory_bound->loads_bound->l1d_loads_bound
-    l1d_loads_mshr_bound = l1d_loads_bound.add_down("L1D Loads MSHR", use('l1d_loads_mshr_bound') / use('total_cycles'))
-    l1d_loads_tlb_bound = l1d_loads_bound.add_down("L1D Loads TLB", use('l1d_loads_tlb_bound') / use('total_cycles'))
-    l1d_loads_store_data_bound = l1d_loads_bound.add_down("L1D Loads sdata", use('l1d_loads_store_data_bound') / use('total_cycles'))
-    l1d_loads_bank_conflict_bound = l1d_loads_bound.add_down("L1D Loads\nBank Conflict", use('l1d_loads_bank_conflict_bound') / use('total_cycles'))
-    l1d_loads_vio_check_redo_bound = l1d_loads_bound.add_down("L1D Loads VioRedo", use('l1d_loads_vio_check_redo_bound') / use('total_cycles'))
+        return dict(csv.reader(file))
+
+
+def get_top_down(path, tree=None):
+    """Compute the TopDown tree of one checkpoint
+
+    Args:
+        path (String): csv path
+        tree (MetricTree): metric tree definition, top_down.toml if None
+
+    Returns:
+        TopDown: the top node
+    """
+    return compute_top_down(read_csv(path), tree)
+
+
+def compute_top_down(counters, tree=None):
+    """Compute the TopDown tree from counters
+
+    Args:
+        counters (dict): counter name -> value string, float or numpy array.
+            With arrays, every node holds one percentage per element.
+        tree (MetricTree): metric tree definition, top_down.toml if None
+
+    Returns:
+        TopDown: the top node
+    """
+    if tree is None:
+        tree = MetricTree()
+    values = tree.evaluate(counters)
+    top, all_nodes = None, {}
+    for node_id, (name, parent) in tree.nodes.items():
+        if parent is None:
+            assert top is None, "Expect exactly one root node"
+            top = all_nodes[node_id] = TopDown(name, values[node_id])
+        else:
+            all_nodes[node_id] = all_nodes[parent].add_down(name, values[node_id])
+    return top
 
 
+def draw_sunburst(top, head):
+    """Draw one chart
+
+    Args:
+        top (TopDown): the top node
+        head (String): chart head
+
+    Returns:
+        Sunburst chart
+    """
     return (
         Sunburst(init_opts=opts.InitOpts(width="1000px", height="1200px"))
         .add(series_name="", data_pair=top.draw(), radius=[0, "90%"])
@@ -174,11 +181,81 @@ def process_one(path, head):
         .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}")))
 
 
-title = sys.argv[1]
-directory = sys.argv[2]
-suffix = sys.argv[3]
-print(title)
-(
-    Page(page_title=title, layout=Page.SimplePageLayout)
-    .add(process_one(directory + "/csv/" + title + ".log.csv", title + "_" + suffix))
-    .render(directory + "/html/" + title + ".html"))
+def process_one(path, head):
+    """Process one chart
+
+    Args:
+        path (String): csv path
+        head (String): chart head
+
+    Returns:
+        Sunburst chart
+    """
+    return draw_sunburst(get_top_down(path), head)
+
+
+def find_csv(directory):
+    """Find every csv/*.log.csv under directory
+
+    Returns:
+        list: (title, csv path) sorted by path
+    """
+    paths = glob.glob(os.path.join(directory, "**", "csv", "*.log.csv"), recursive=True)
+    return [(os.path.basename(path)[:-len(".log.csv")], path) for path in sorted(paths)]
+
+
+def process_batch(directory, suffix, jobs, combined, tree=None):
+    """Compute TopDown trees of all checkpoints in a process pool and render them from this process
+
+    Args:
+        directory (String): directory to search csv/*.log.csv
+        suffix (String): chart head suffix
+        jobs (int): number of processes
+        combined (bool): render all charts on one page instead of one page per checkpoint
+        tree (MetricTree): metric tree definition, top_down.toml if None
+    """
+    all_csv = find_csv(directory)
+    with Pool(jobs) as pool:
+        all_top = pool.map(partial(get_top_down, tree=tree), [path for _, path in all_csv])
+    if combined:
+        page = Page(page_title=os.path.basename(os.path.realpath(directory)), layout=Page.SimplePageLayout)
+        for (title, _), top in zip(all_csv, all_top):
+            page.add(draw_sunburst(top, title + "_" + suffix))
+        os.makedirs(os.path.join(directory, "html"), exist_ok=True)
+        page.render(os.path.join(directory, "html", "top_down.html"))
+        return
+    for (title, path), top in zip(all_csv, all_top):
+        # csv/<title>.log.csv -> html/<title>.html
+        html_dir = os.path.join(os.path.dirname(os.path.dirname(path)), "html")
+        os.makedirs(html_dir, exist_ok=True)
+        (
+            Page(page_title=title, layout=Page.SimplePageLayout)
+            .add(draw_sunburst(top, title + "_" + suffix))
+            .render(os.path.join(html_dir, title + ".html")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="draw top-down sunburst charts")
+    parser.add_argument("title", nargs="?", type=str, help="checkpoint name, reads <directory>/csv/<title>.log.csv")
+    parser.add_argument("directory", nargs="?", type=str, help="directory of csv and html")
+    parser.add_argument("suffix", nargs="?", type=str, default="", help="chart head suffix")
+    parser.add_argument("--batch", type=str, help="process every csv/*.log.csv under this directory")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="number of processes in batch mode")
+    parser.add_argument("--combined", action="store_true", help="render all charts on one page in batch mode")
+    parser.add_argument("--batch-suffix", type=str, default="", help="chart head suffix in batch mode")
+    parser.add_argument("--tree", type=str, help="metric tree definition (default: top_down.toml)")
+    args = parser.parse_args()
+    tree = MetricTree(args.tree)
+
+    if args.batch is not None:
+        process_batch(args.batch, args.batch_suffix, args.jobs, args.combined, tree)
+        sys.exit(0)
+
+    title = args.title
+    directory = args.directory
+    suffix = args.suffix
+    print(title)
+    (
+        Page(page_title=title, layout=Page.SimplePageLayout)
+        .add(draw_sunburst(get_top_down(directory + "/csv/" + title + ".log.csv", tree), title + "_" + suffix))
+        .render(directory + "/html/" + title + ".html"))
@@ -0,0 +1,180 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Top-down over time (phase view) of one emu log with periodic perf dumps
+#
+# Every dump prints all counters with the same [time=N], one dump becomes one row of a
+# PerfStore. Cumulative counters are differenced into per-interval deltas, and the whole
+# metric tree is evaluated once with one element per interval.
+#
+#   python3 top_down_phase.py emu.log -o phase.csv --html phase.html
+
+import argparse
+
+import numpy as np
+from pyecharts import options as opts
+from pyecharts.charts import Line, Page
+
+from metric_tree import MetricTree
+from perf_counter import parse_perf_line
+from perf_store import PerfStore
+from simpoint_top_down import flatten, get_breakdown
+
+
+def parse_dump_time(line):
+    """The N of "[PERF ][time=   N]", or None"""
+    begin = line.find("time=")
+    end = line.find("]", begin)
+    if begin == -1 or end == -1:
+        return None
+    try:
+        return int(line[begin + len("time="):end])
+    except ValueError:
+        return None
+
+
+def parse_dumps(filename):
+    """All perf dumps of one emu log, one run per dump time
+
+    Returns:
+        PerfStore: runs are dump times in order, values are counters as printed
+    """
+    dumps = {}
+    with open(filename, errors="replace", buffering=1 << 20) as f:
+        for line in f:
+            if not line.startswith("[PERF ]"):
+                continue
+            time = parse_dump_time(line)
+            perf = parse_perf_line(line)
+            if time is None or perf is None:
+                continue
+            module, name, value = perf
+            try:
+                dumps.setdefault(time, {})[module + ": " + name] = int(value)
+            except ValueError:
+                continue
+    times = sorted(dumps)
+    return PerfStore.from_counters([str(time) for time in times], [dumps[time] for time in times])
+
+
+def get_deltas(store, cleared=False):
+    """Per-interval counters
+
+    Args:
+        store (PerfStore): one run per dump
+        cleared (bool): counters are cleared after every dump, so dumps are already deltas
+
+    Returns:
+        np.array: int64 [interval, counter], interval i ends at dump i, intervals
+        whose dump lacks a counter stay invalid in store.valid
+    """
+    if cleared:
+        return np.where(store.valid, store.values, 0)
+    # a counter missing from a dump keeps its last valid value, so the next interval
+    # gets the increase since then instead of the whole cumulative value
+    rows = np.arange(len(store.runs))[:, None]
+    last_valid = np.maximum.accumulate(np.where(store.valid, rows, -1), axis=0)
+    values = np.where(last_valid >= 0, np.take_along_axis(store.values, np.maximum(last_valid, 0), axis=0), 0)
+    deltas = np.diff(values, axis=0, prepend=0)
+    # a counter going backwards was reset (e.g. after warmup), its value is the delta
+    return np.where(deltas < 0, values, deltas)
+
+
+def get_phases(store, tree=None, cleared=False):
+    """Top-down of every interval
+
+    Returns:
+        (names, counters): top-down counter names and a float [interval, counter] array
+    """
+    if tree is None:
+        tree = MetricTree()
+    deltas = PerfStore(store.runs, store.keys, get_deltas(store, cleared), store.valid)
+    arrays = deltas.extract_arrays(tree.get_counter_specs())
+    names = list(arrays)
+    return names, np.stack([arrays[name] for name in names], axis=1).reshape(len(store.runs), len(names))
+
+
+def get_ipc(names, counters):
+    """IPC of every interval, committed uops if commitInstr is not in the log"""
+    instrs = counters[:, names.index("total_instrs")]
+    if np.isnan(instrs).all():
+        instrs = counters[:, names.index("slots_retired")]
+    return instrs / counters[:, names.index("total_cycles")]
+
+
+def print_phases(times, ipc, top, level):
+    nodes = [node for _, node in flatten(top) if node.level == level]
+    print(f"{'time':>12} {'IPC':>6} " + " ".join(f"{node.name.replace(chr(10), ' '):>16}" for node in nodes))
+    for i, time in enumerate(times):
+        print(f"{time:>12} {ipc[i]:>6.3f} " + " ".join(f"{node.percentage[i] * 100:>15.2f}%" for node in nodes))
+
+
+def write_phases(output_file, times, ipc, top):
+    nodes = flatten(top)
+    with open(output_file, "w") as f:
+        f.write(",".join(["time", "ipc"] + [path for path, _ in nodes]) + "\n")
+        for i, time in enumerate(times):
+            row = [time, str(ipc[i])] + [str(float(np.broadcast_to(node.percentage, ipc.shape)[i])) for _, node in nodes]
+            f.write(",".join(row) + "\n")
+
+
+def draw_phases(times, ipc, top, level, head):
+    """Stacked area chart of the nodes at one level, and IPC, over time"""
+    nodes = [node for _, node in flatten(top) if node.level == level]
+    line = (
+        Line(init_opts=opts.InitOpts(width="1600px", height="800px"))
+        .add_xaxis(times)
+        .set_global_opts(
+            title_opts=opts.TitleOpts(title=head),
+            tooltip_opts=opts.TooltipOpts(trigger="axis"),
+            yaxis_opts=opts.AxisOpts(name="slots (%)", max_=100),
+            datazoom_opts=[opts.DataZoomOpts()]))
+    for node in nodes:
+        line.add_yaxis(
+            node.name.replace("\n", " "),
+            np.round(np.broadcast_to(node.percentage, ipc.shape) * 100, 2).tolist(),
+            stack="top-down",
+            areastyle_opts=opts.AreaStyleOpts(opacity=0.5),
+            label_opts=opts.LabelOpts(is_show=False))
+    line.extend_axis(yaxis=opts.AxisOpts(name="IPC", position="right"))
+    line.add_yaxis("IPC", np.round(ipc, 3).tolist(), yaxis_index=1, label_opts=opts.LabelOpts(is_show=False))
+    return line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="top-down over time of an emu log with periodic perf dumps")
+    parser.add_argument("filename", type=str, help="emu log")
+    parser.add_argument("--cleared", action="store_true", help="counters are cleared after every dump")
+    parser.add_argument("--level", type=int, default=1, help="tree level to print and draw (default: 1)")
+    parser.add_argument("--output", "-o", type=str, help="write all nodes of every interval to this csv")
+    parser.add_argument("--html", type=str, help="draw the phases to this html")
+    parser.add_argument("--tree", type=str, help="metric tree definition (default: top_down.toml)")
+    args = parser.parse_args()
+
+    store = parse_dumps(args.filename)
+    assert store.runs, f"No perf dump found in {args.filename}"
+    tree = MetricTree(args.tree)
+    names, counters = get_phases(store, tree, args.cleared)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ipc = get_ipc(names, counters)
+    top = get_breakdown(names, counters, tree)
+    print_phases(store.runs, ipc, top, args.level)
+    if args.output is not None:
+        write_phases(args.output, store.runs, ipc, top)
+    if args.html is not None:
+        page = Page(page_title="top-down phases", layout=Page.SimplePageLayout)
+        page.add(draw_phases(store.runs, ipc, top, args.level, args.filename))
+        page.render(args.html)
@@ -0,0 +1,29 @@
+#***************************************************************************************
+# Copyright (c) 2020-2021 Institute of Computing Technology, Chinese Academy of Sciences
+# Copyright (c) 2020-2021 Peng Cheng Laboratory
+#
+# XiangShan is licensed under Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#          http://license.coscl.org.cn/MulanPSL2
+#
+# THIS SOFTWARE IS PROVIDED ON AN "AS IS" BASIS, WITHOUT WARRANTIES OF ANY KIND,
+# EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
+# MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
+#
+# See the Mulan PSL v2 for more details.
+#***************************************************************************************
+
+# Patterns of the generated verilog shared by parser.py and statistics.py
+#
+# Kept apart from parser.py, which needs xlsxwriter and is shadowed by the built-in
+# parser module of python <= 3.9 when imported.
+
+import re
+
+# module name [#(parameters)] [import pkg::*;] [#(]
+module_re = re.compile(r'^\s*module\s+(\w+)\s*(#\s*\(.+\))?\s*(import\s+\w+\s*::\*\s*;)?\s*(#\s*\()?')
+# Module [#(...)] instance (
+submodule_re = re.compile(r'^\s*(\w+)\s*(#\(.*\)|)\s*(\w+)\s*\(\s*(|//.*)\s*$')
+# sram_array_<ports>p<depth>x<width>m<mask granularity>[_multicycle][_repair], may have a module prefix
+SRAM_ARRAY_NAME = r"sram_array_(\d)p(\d+)x(\d+)m(\d+)(_multicycle|)(_repair|)"
@@ -17,32 +17,37 @@
 # Simple version of xiangshan python wrapper
 
 import argparse
-import json
+import glob
 import os
 import random
+import shutil
 import signal
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
-import psutil
+from artifacts import ArtifactCollector
+from build_cache import DEFAULT_CACHE_DIR as DEFAULT_BUILD_CACHE_DIR, BuildCache
+from checkpoints import load_checkpoints
+from cores import CoreAllocator
+from emu_speed import DEFAULT_HISTORY as DEFAULT_SPEED_HISTORY, EmuProgress, OutputTee, SpeedHistory, format_speed, get_commit
+from shards import get_commit_time, load_durations, parse_shard, print_plan, split_lpt
+from telemetry import Telemetry, TreeSampler, wait_rusage
+
+# return codes of commands stopped by xiangshan.py, as used by timeout(1) and shells
+TIMEOUT_RETURN_CODE = 124
+INTERRUPT_RETURN_CODE = 130
+
+# files in $NOOP_HOME/build collected to $WAVE_HOME when a CI workload fails
+WAVE_FILES = ["*.vcd"]
+BUILD_ARTIFACTS = ["emu", "SimTop.v"]
 
 
 def load_all_gcpt(gcpt_path, json_path):
-    all_gcpt = []
-    with open(json_path) as f:
-        data = json.load(f)
-    for benchspec in data:
-        for point in data[benchspec]:
-            weight = data[benchspec][point]
-            gcpt = os.path.join(gcpt_path, "_".join([benchspec, point, weight]))
-            bin_dir = os.path.join(gcpt, "0")
-            bin_file = list(os.listdir(bin_dir))
-            assert(len(bin_file) == 1)
-            bin_path = os.path.join(bin_dir, bin_file[0])
-            assert(os.path.isfile(bin_path))
-            all_gcpt.append(bin_path)
-    return all_gcpt
+    return [checkpoint["path"] for checkpoint in load_checkpoints(gcpt_path, json_path)]
 
 
 class XSArgs(object):
@@ -77,6 +82,7 @@ class XSArgs(object):
         self.is_release = 1 if args.release else None
         self.trace = 1 if args.trace or not args.disable_fork else None
         self.config = args.config
+        self.build_cache = args.build_cache
         # emu arguments
         self.max_instr = args.max_instr
         self.seed = random.randint(0, 9999)
@@ -84,6 +90,16 @@ class XSArgs(object):
         self.diff = args.diff
         self.fork = not args.disable_fork
         self.disable_diff = args.no_diff
+        self.speed_history = args.speed_history
+        # CI arguments
+        self.jobs = args.jobs
+        self.fail_fast = args.fail_fast
+        self.drain_timeout = args.drain_timeout
+        self.timeout_ok = args.timeout_ok
+        self.wait_artifacts = args.wait_artifacts
+        self.shard = args.shard
+        self.shard_history = args.shard_history
+        self.replay_window = args.replay_failure
         # wave dump path
         if args.wave_dump is not None:
             self.set_wave_home(args.wave_dump)
@@ -181,6 +197,16 @@ class XiangShan(object):
     def __init__(self, args):
         self.args = XSArgs(args)
         self.timeout = args.timeout
+        # process groups of running commands, for --jobs
+        self.procs = set()
+        self.lock = threading.Lock()
+        # set when running commands are stopped, no new ones are started then
+        self.stopping = threading.Event()
+        # created on the first --numa run, it needs a lock directory in /tmp
+        self.cores = None
+        self.telemetry = Telemetry(args.telemetry) if args.telemetry is not None else None
+        self.speed_history = SpeedHistory(self.args.speed_history) if self.args.speed_history is not None else None
+        self.commit = None
 
     def show(self):
         self.args.show()
@@ -188,7 +214,7 @@ class XiangShan(object):
     def make_clean(self):
         print("Clean up CI workspace")
         self.show()
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME clean')
+        return_code = self.__exec_cmd(f'make -C $NOOP_HOME clean', action="clean")
         return return_code
 
     def generate_verilog(self):
@@ -196,7 +222,7 @@ class XiangShan(object):
         self.show()
         sim_args = " ".join(self.args.get_chisel_args(prefix="--"))
         make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME verilog SIM_ARGS="{sim_args}" {make_args}')
+        return_code = self.__make_cached("verilog", f'make -C $NOOP_HOME verilog SIM_ARGS="{sim_args}" {make_args}')
         return return_code
 
     def generate_sim_verilog(self):
@@ -204,7 +230,7 @@ class XiangShan(object):
         self.show()
         sim_args = " ".join(self.args.get_chisel_args(prefix="--"))
         make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME sim-verilog SIM_ARGS="{sim_args}" {make_args}')
+        return_code = self.__make_cached("sim-verilog", f'make -C $NOOP_HOME sim-verilog SIM_ARGS="{sim_args}" {make_args}')
         return return_code
 
     def build_emu(self):
@@ -212,7 +238,19 @@ class XiangShan(object):
         self.show()
         sim_args = " ".join(self.args.get_chisel_args(prefix="--"))
         make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME emu -j200 SIM_ARGS="{sim_args}" {make_args}')
+        return_code = self.__make_cached("emu", f'make -C $NOOP_HOME emu -j200 SIM_ARGS="{sim_args}" {make_args}')
+        return return_code
+
+    def __make_cached(self, target, cmd):
+        if self.args.build_cache is None:
+            return self.__exec_cmd(cmd, action=target)
+        cache = BuildCache(self.args.noop_home, self.args.build_cache, dramsim3_home=self.args.dramsim3_home)
+        key = cache.get_key(target, self.args.get_makefile_args(), self.args.get_chisel_args())
+        if cache.restore(key, target):
+            return 0
+        return_code = self.__exec_cmd(cmd, action=target)
+        if return_code == 0:
+            cache.store(key, target)
         return return_code
 
     def build_simv(self):
@@ -225,31 +263,136 @@ class XiangShan(object):
             eval `/usr/bin/modulecmd zsh load synopsys/vcs/Q-2020.03-SP2`;\
             eval `/usr/bin/modulecmd zsh load synopsys/verdi/S-2021.09-SP1`;\
             VERDI_HOME=/nfs/tools/synopsys/verdi/S-2021.09-SP1 \
-            make -C $NOOP_HOME simv {make_args} CONSIDER_FSDB=1')  # set CONSIDER_FSDB for compatibility
+            make -C $NOOP_HOME simv {make_args} CONSIDER_FSDB=1', action="simv")  # set CONSIDER_FSDB for compatibility
         return return_code
 
-    def run_emu(self, workload):
+    def run_emu(self, workload, log_file=None, numa=None, wave_dir=None):
+        """Run emu on a workload
+
+        Args:
+            wave_dir (str): directory named build for the waveforms, instead of $NOOP_HOME/build
+        """
         print("Running XiangShan emu with the following configurations:")
         self.show()
-        emu_args = " ".join(map(lambda arg: f"--{arg[1]} {arg[0]}", self.args.get_emu_args()))
         print("workload:", workload)
+        numa = self.args.numa if numa is None else numa
+        wave_dir = wave_dir or os.path.join(self.args.noop_home, "build")
+        start = time.time()
+        return_code, progress = self.__exec_emu(workload, log_file, numa, self.args.fork, wave_dir)
+        self.__report_speed(workload, progress, return_code, numa)
+        failed = return_code not in (0, TIMEOUT_RETURN_CODE, INTERRUPT_RETURN_CODE)
+        if failed and self.args.replay_window is not None and not self.stopping.is_set():
+            self.__replay_failure(workload, log_file, numa, wave_dir, progress, start)
+        return return_code
+
+    def __exec_emu(self, workload, log_file, numa, fork, wave_dir, extra_args="", action="emu"):
+        emu_args = " ".join(map(lambda arg: f"--{arg[1]} {arg[0]}", self.args.get_emu_args()))
         numa_args = ""
-        if self.args.numa:
-            numa_info = get_free_cores(self.args.threads)
-            numa_args = f"numactl -m {numa_info[0]} -C {numa_info[1]}-{numa_info[2]}"
-        fork_args = "--enable-fork" if self.args.fork else ""
+        if numa:
+            with self.lock:
+                if self.cores is None:
+                    self.cores = CoreAllocator()
+            interrupted = False
+            try:
+                window = self.cores.acquire(self.args.threads or 1, self.timeout, stop=self.stopping)
+            except KeyboardInterrupt:
+                window, interrupted = None, True
+            if window is None:
+                # stopped by --fail-fast or Ctrl-C, or no cores were free within --timeout
+                timed_out = not interrupted and not self.stopping.is_set()
+                print(f"No cores for {workload}, {'timed out' if timed_out else 'stopped'} while waiting")
+                return (TIMEOUT_RETURN_CODE if timed_out else INTERRUPT_RETURN_CODE), EmuProgress()
+            numa_args = window.numactl_args()
+        fork_args = "--enable-fork" if fork else ""
         diff_args = "--no-diff" if self.args.disable_diff else ""
-        return_code = self.__exec_cmd(f'{numa_args} $NOOP_HOME/build/emu -i {workload} {emu_args} {fork_args} {diff_args}')
-        return return_code
+        emu = os.path.join(self.args.noop_home, "build", "emu")
+        # emu writes waveforms and LightSSS snapshots to $NOOP_HOME/build
+        env = {"NOOP_HOME": os.path.dirname(wave_dir)}
+        progress = EmuProgress()
+        try:
+            return_code = self.__exec_cmd(f'{numa_args} {emu} -i {workload} {emu_args} {fork_args} {diff_args} {extra_args}', log_file,
+                                          action=f"{action}:{os.path.basename(workload)}", progress=progress, env=env)
+        finally:
+            if numa:
+                window.release()
+        return return_code, progress
+
+    def __get_new_waves(self, wave_dir, since):
+        waves = glob.glob(os.path.join(wave_dir, "*.vcd")) + glob.glob(os.path.join(wave_dir, "*.fst"))
+        return sorted(wave for wave in waves if os.path.getmtime(wave) >= since)
+
+    def __replay_failure(self, workload, log_file, numa, wave_dir, progress, start):
+        """Get the waveform of a failed emu run
+
+        With LightSSS, emu itself replays the last snapshot with waveform when it fails. If
+        that left no waveform, emu runs again with the same seed and dumps the last
+        --replay-failure cycles before the failure, like the go back of autorun. The run
+        starts again from cycle 0, so this doubles the time of the failed run.
+
+        Waveforms are looked up in wave_dir, which only this run writes to.
+        """
+        waves = self.__get_new_waves(wave_dir, start)
+        if self.args.fork and waves:
+            print(f"LightSSS dumped the waveform of {workload}: {' '.join(waves)}")
+            return
+        fail_cycle = progress.get_cycles()
+        if fail_cycle is None:
+            print(f"No cycleCnt reported for {workload}, the failure cannot be replayed")
+            return
+        begin = max(0, fail_cycle - self.args.replay_window)
+        print(f"Replay {workload} from cycle 0 with waveform from cycle {begin} to the failure at cycle {fail_cycle}")
+        replay_start = time.time()
+        replay_log = f"{os.path.splitext(log_file)[0]}-replay.log" if log_file is not None else None
+        return_code, replay = self.__exec_emu(workload, replay_log, numa, False, wave_dir, f"-b {begin} -e -1 --dump-wave", action="replay")
+        replay_cycle = replay.get_cycles()
+        if return_code == 0:
+            print(f"Failure of {workload} is not reproduced, it may be nondeterministic")
+        elif return_code in (TIMEOUT_RETURN_CODE, INTERRUPT_RETURN_CODE):
+            print(f"Replay of {workload} is stopped")
+        elif replay_cycle != fail_cycle:
+            print(f"Replay of {workload} failed at cycle {replay_cycle} instead of {fail_cycle}")
+        else:
+            print(f"Failure of {workload} is reproduced at cycle {fail_cycle}")
+        waves = self.__get_new_waves(wave_dir, replay_start)
+        print(f"Waveform of the replay: {' '.join(waves) if waves else 'none, is emu built with --trace?'}")
+
+    def __report_speed(self, workload, progress, return_code, numa=None, history=True):
+        speed = progress.get_speed()
+        if return_code == TIMEOUT_RETURN_CODE:
+            reached = format_speed(speed) if speed is not None else "no progress reported"
+            print(f"TIMEOUT {workload} after {self.timeout} seconds, {reached}")
+            return
+        if speed is None:
+            print(f"No simulation speed reported for {workload}")
+            return
+        print(f"Simulation speed of {os.path.basename(workload)}: {format_speed(speed)}")
+        if self.speed_history is None or not history:
+            return
+        if self.commit is None:
+            self.commit = get_commit(self.args.noop_home)
+        # everything that changes the speed of the same emu binary
+        build = {name: value for value, name in self.args.get_makefile_args()}
+        build.update({"numa": bool(numa), "fork": self.args.fork, "diff": not self.args.disable_diff})
+        self.speed_history.write(workload, speed, return_code, self.commit, build)
 
     def run_simv(self, workload):
         print("Running XiangShan simv with the following configurations:")
         self.show()
         diff_args = "$NOOP_HOME/"+ args.diff
-        return_code = self.__exec_cmd(f'$NOOP_HOME/difftest/simv +workload={workload} +diff={diff_args}')
+        progress = EmuProgress()
+        return_code = self.__exec_cmd(f'$NOOP_HOME/difftest/simv +workload={workload} +diff={diff_args}',
+                                      action=f"simv:{os.path.basename(workload)}", progress=progress)
+        self.__report_speed(workload, progress, return_code, history=False)
         return return_code
 
     def run(self, args):
+        ret = self.__run_actions(args)
+        if ret == TIMEOUT_RETURN_CODE and self.args.timeout_ok:
+            print("Timed out runs are not failures with --timeout-ok")
+            return 0
+        return ret
+
+    def __run_actions(self, args):
         if args.ci is not None:
             return self.run_ci(args.ci)
         if args.ci_vcs is not None:
@@ -270,21 +413,160 @@ class XiangShan(object):
                 return ret
         return 0
 
-    def __exec_cmd(self, cmd):
+    def __exec_cmd(self, cmd, log_file=None, action="cmd", progress=None, env=None):
+        extra_env = env or {}
         env = dict(os.environ)
         env.update(self.args.get_env_variables())
+        env.update(extra_env)
         print("subprocess call cmd:", cmd)
         start = time.time()
-        proc = subprocess.Popen(cmd, shell=True, env=env, preexec_fn=os.setsid)
+        log = open(log_file, "w") if log_file is not None else None
+        if progress is None:
+            proc = subprocess.Popen(cmd, shell=True, env=env, preexec_fn=os.setsid, stdout=log, stderr=log and subprocess.STDOUT)
+            tees = []
+        else:
+            # emu prints its counters to stderr, which is copied to where it would go and
+            # parsed on the way, stdout (with --enable-log, most of the output) is left alone
+            sys.stdout.flush()
+            proc = subprocess.Popen(cmd, shell=True, env=env, preexec_fn=os.setsid, stdout=log, stderr=subprocess.PIPE)
+            stderr_fd = log.fileno() if log is not None else sys.stderr.fileno()
+            tees = [OutputTee(proc.stderr, stderr_fd, progress)]
+        with self.lock:
+            self.procs.add(proc)
+        sampler = TreeSampler(proc.pid) if self.telemetry is not None else nullcontext()
+        rusage = None
         try:
-            return_code = proc.wait(self.timeout)
+            with sampler:
+                try:
+                    return_code, rusage = wait_rusage(proc, self.timeout)
+                except (KeyboardInterrupt, subprocess.TimeoutExpired) as e:
+                    timed_out = isinstance(e, subprocess.TimeoutExpired)
+                    print(f"{'TimeoutExpired' if timed_out else 'KeyboardInterrupt'} after {time.time() - start:.1f} seconds")
+                    rusage = self.__drain(proc)
+                    return TIMEOUT_RETURN_CODE if timed_out else INTERRUPT_RETURN_CODE
             end = time.time()
             print(f"Elapsed time: {end - start} seconds")
             return return_code
+        finally:
+            for tee in tees:
+                # forked children may keep the pipes open after emu exits, a tee still
+                # running then writes to its own copy of the log fd, so log can be closed
+                tee.join(timeout=10)
+            with self.lock:
+                self.procs.discard(proc)
+            if log is not None:
+                log.close()
+            if self.telemetry is not None:
+                self.telemetry.write(action, cmd, start, proc.returncode, rusage, sampler.peak_rss)
+
+    def __signal(self, proc, sig):
+        try:
+            os.killpg(os.getpgid(proc.pid), sig)
+        except ProcessLookupError:
+            pass
+
+    def __drain(self, proc):
+        """Stop a command and wait for it to exit
+
+        emu stops at SIGINT, prints its instrCnt and cycleCnt and flushes its logs and
+        LightSSS state. It is killed if that takes more than --drain-timeout seconds.
+
+        Returns:
+            resource.struct_rusage: resource usage of the command
+        """
+        self.__signal(proc, signal.SIGINT)
+        try:
+            return wait_rusage(proc, self.args.drain_timeout)[1]
         except (KeyboardInterrupt, subprocess.TimeoutExpired):
-            os.killpg(os.getpgid(proc.pid), signal.SIGINT)
-            print(f"KeyboardInterrupt or TimeoutExpired.")
+            print(f"Not stopped in {self.args.drain_timeout} seconds, kill it")
+            self.__signal(proc, signal.SIGKILL)
+            return wait_rusage(proc)[1]
+
+    def __stop_all(self):
+        self.stopping.set()
+        with self.lock:
+            for proc in self.procs:
+                self.__signal(proc, signal.SIGINT)
+
+    def __run_parallel(self, targets, run_func):
+        """Run independent workloads in --jobs threads, each with its own log and wave directory
+
+        Wave directories are $NOOP_HOME/build/jobs/<workload>/build, only kept for failed workloads.
+
+        Returns:
+            (int, list): return code of the first failed workload, 0 if all passed, and the
+            wave directories of failed workloads
+        """
+        log_dir = os.path.join(self.args.wave_home, "ci-logs")
+        os.makedirs(log_dir, exist_ok=True)
+        names = [f"{i:03d}-{os.path.basename(target)}" for i, target in enumerate(targets)]
+        logs = [os.path.join(log_dir, f"{name}.log") for name in names]
+        wave_dirs = [os.path.join(self.args.noop_home, "build", "jobs", name, "build") for name in names]
+
+        def run_one(target, log, wave_dir):
+            # workers may pick up the next workload before the failure is handled
+            if self.stopping.is_set():
+                return None
+            shutil.rmtree(wave_dir, ignore_errors=True)
+            os.makedirs(wave_dir)
+            ret = run_func(target, log, wave_dir=wave_dir)
+            # emu exits with its own return code when stop_all interrupts it
+            return INTERRUPT_RETURN_CODE if ret and self.stopping.is_set() else ret
+
+        def stop_all():
+            for f in futures:
+                f.cancel()
+            self.__stop_all()
+
+        first_failure, interrupted = 0, False
+        with ThreadPoolExecutor(max_workers=self.args.jobs) as pool:
+            futures = {pool.submit(run_one, *job): i for i, job in enumerate(zip(targets, logs, wave_dirs))}
+            try:
+                for future in as_completed(futures):
+                    i = futures[future]
+                    ret = future.result() if not future.cancelled() else None
+                    # timed out and stopped workloads are reported in the summary, not failures
+                    if ret not in (None, 0, TIMEOUT_RETURN_CODE, INTERRUPT_RETURN_CODE) and not first_failure:
+                        first_failure = ret
+                        print(f"{targets[i]} failed with {ret}, see {logs[i]}")
+                        if self.args.fail_fast:
+                            stop_all()
+            except KeyboardInterrupt:
+                # only this thread gets the signal, the workers stop when their commands exit
+                print("KeyboardInterrupt, stopping all workloads")
+                interrupted = True
+                stop_all()
+        results = {i: f.result() for f, i in futures.items() if not f.cancelled()}
+        timed_out, failed_wave_dirs = [], []
+        for i, target in enumerate(targets):
+            if results.get(i) is None:
+                status = "skipped"
+            elif results[i] == 0:
+                status = "passed"
+            elif results[i] == TIMEOUT_RETURN_CODE:
+                status = "timeout"
+                timed_out.append(target)
+            elif results[i] == INTERRUPT_RETURN_CODE:
+                # by --fail-fast or KeyboardInterrupt
+                status = "stopped"
+            else:
+                status = f"failed ({results[i]})"
+                failed_wave_dirs.append(wave_dirs[i])
+            print(f"{status:<12} {target} {logs[i]}")
+            if wave_dirs[i] not in failed_wave_dirs:
+                shutil.rmtree(os.path.dirname(wave_dirs[i]), ignore_errors=True)
+        if interrupted:
+            return INTERRUPT_RETURN_CODE, failed_wave_dirs
+        return first_failure or self.__get_timeout_result(timed_out), failed_wave_dirs
+
+    def __get_timeout_result(self, timed_out):
+        """Return code of CI workloads that passed except timed out ones"""
+        if not timed_out:
             return 0
+        print(f"{len(timed_out)} workload(s) timed out after {self.timeout} seconds:")
+        for target in timed_out:
+            print(f"    {target}")
+        return TIMEOUT_RETURN_CODE
 
     def __get_ci_cputest(self, name=None):
         base_dir = os.path.join(self.args.am_home, "tests/cputest/build")
@@ -426,17 +708,68 @@ class XiangShan(object):
             "microbench": self.__am_apps_path,
             "coremark": self.__am_apps_path
         }
-        for target in all_tests.get(test, self.__get_ci_workloads)(test):
+        targets = self.__get_shard(all_tests.get(test, self.__get_ci_workloads)(test))
+        if self.args.jobs > 1:
+            ret, failed_wave_dirs = self.__run_parallel(list(targets), self.run_emu)
+            if failed_wave_dirs:
+                self.__copy_wave(failed_wave_dirs)
+            return ret
+        timed_out = []
+        for target in targets:
             print(target)
             ret = self.run_emu(target)
-            if ret:
-                if self.args.default_wave_home != self.args.wave_home:
-                    print("copy wave file to " + self.args.wave_home)
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.vcd $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/emu $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/SimTop.v $WAVE_HOME")
+            if ret == TIMEOUT_RETURN_CODE:
+                timed_out.append(target)
+            elif ret:
+                if ret != INTERRUPT_RETURN_CODE:
+                    self.__copy_wave()
                 return ret
-        return 0
+        return self.__get_timeout_result(timed_out)
+
+    def __get_shard(self, targets):
+        """Workloads of this --shard, balanced by recorded durations, all of them without --shard"""
+        targets = list(targets)
+        if self.args.shard is None:
+            return targets
+        index, count = self.args.shard
+        # every shard computes the plan by itself, so all of them must read the same file
+        # and not the records written by other shards meanwhile
+        history = self.args.shard_history
+        commit_time = get_commit_time(self.args.noop_home)
+        durations = {}
+        if history is None:
+            print("No --shard-history, shards are balanced by the number of workloads")
+        elif not os.path.isfile(history):
+            print(f"[WARNING] {history} does not exist, shards are balanced by the number of workloads")
+        elif commit_time is None:
+            print("[WARNING] no commit time of $NOOP_HOME, shards are balanced by the number of workloads")
+        else:
+            durations = load_durations([history], before=commit_time)
+        shards = split_lpt(targets, durations, count)
+        print_plan(shards, index)
+        return shards[index - 1][1]
+
+    def __copy_wave(self, wave_dirs=None):
+        """Collect the build artifacts and the waveforms in wave_dirs, $NOOP_HOME/build by default"""
+        if self.args.default_wave_home == self.args.wave_home:
+            return
+        build_dir = os.path.join(self.args.noop_home, "build")
+        files, names = [], []
+        for wave_dir in wave_dirs or [build_dir]:
+            # waveforms of parallel jobs are named by their job, build/jobs/<job>/build/<wave>
+            prefix = "" if wave_dirs is None else os.path.basename(os.path.dirname(wave_dir)) + "-"
+            for pattern in WAVE_FILES:
+                for wave in sorted(glob.glob(os.path.join(wave_dir, pattern))):
+                    files.append(wave)
+                    names.append(prefix + os.path.basename(wave))
+        for pattern in BUILD_ARTIFACTS:
+            for artifact in sorted(glob.glob(os.path.join(build_dir, pattern))):
+                files.append(artifact)
+                names.append(os.path.basename(artifact))
+        collector = ArtifactCollector(self.args.wave_home, os.path.join(build_dir, ".artifacts"))
+        # waveforms are compressed in a detached process, see $WAVE_HOME/manifest-<collection>.json
+        manifest = collector.collect(files, background=not self.args.wait_artifacts, names=names)
+        print(f"collect {len(manifest['artifacts'])} wave files to {self.args.wave_home} as {collector.collection}")
 
     def run_ci_vcs(self, test):
         all_tests = {
@@ -448,29 +781,17 @@ class XiangShan(object):
             "microbench": self.__am_apps_path,
             "coremark": self.__am_apps_path
         }
-        for target in all_tests.get(test, self.__get_ci_workloads)(test):
+        timed_out = []
+        for target in self.__get_shard(all_tests.get(test, self.__get_ci_workloads)(test)):
             print(target)
             ret = self.run_simv(target)
-            if ret:
-                if self.args.default_wave_home != self.args.wave_home:
-                    print("copy wave file to " + self.args.wave_home)
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.vcd $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/emu $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/SimTop.v $WAVE_HOME")
+            if ret == TIMEOUT_RETURN_CODE:
+                timed_out.append(target)
+            elif ret:
+                if ret != INTERRUPT_RETURN_CODE:
+                    self.__copy_wave()
                 return ret
-        return 0
-
-def get_free_cores(n):
-    while True:
-        # To avoid potential conflicts, we allow CI to use SMT.
-        num_logical_core = psutil.cpu_count(logical=True)
-        core_usage = psutil.cpu_percent(interval=1, percpu=True)
-        num_window = num_logical_core // n
-        for i in range(num_window):
-            window_usage = core_usage[i * n : i * n + n]
-            if sum(window_usage) < 0.3 * n and True not in map(lambda x: x > 0.5, window_usage):
-                return (((i * n) % 128)// 64, i * n, i * n + n - 1)
-        print(f"No free {n} cores found. CPU usage: {core_usage}\n")
+        return self.__get_timeout_result(timed_out)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Python wrapper for XiangShan')
@@ -485,12 +806,22 @@ if __name__ == "__main__":
     parser.add_argument('--ci-vcs', nargs='?', type=str, const="", help='run CI tests on simv')
     parser.add_argument('--clean', action='store_true', help='clean up XiangShan CI workspace')
     parser.add_argument('--timeout', nargs='?', type=int, default=None, help='timeout (in seconds)')
+    parser.add_argument('--drain-timeout', type=int, default=60,
+                        help='seconds for a timed out command to flush logs after SIGINT before it is killed')
+    parser.add_argument('--timeout-ok', action='store_true', help='exit with 0 instead of 124 when runs time out')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of CI workloads to run in parallel')
+    parser.add_argument('--fail-fast', action='store_true', help='stop other CI workloads after the first failure')
+    parser.add_argument('--shard', type=parse_shard, help='run the i-th of N CI shards (i/N), balanced by durations in --shard-history')
+    parser.add_argument('--shard-history', type=str,
+                        help='speed history or telemetry file read by all shards, e.g. on NFS (default: balance by the number of workloads)')
+    parser.add_argument('--telemetry', type=str, help='append resource usage of every command to this JSON-lines file')
     # environment variables
     parser.add_argument('--nemu', nargs='?', type=str, help='path to nemu')
     parser.add_argument('--am', nargs='?', type=str, help='path to nexus-am')
     parser.add_argument('--dramsim3', nargs='?', type=str, help='path to dramsim3')
     parser.add_argument('--rvtest', nargs='?', type=str, help='path to riscv-tests')
     parser.add_argument('--wave-dump', nargs='?', type=str , help='path to dump wave')
+    parser.add_argument('--wait-artifacts', action='store_true', help='collect wave files before exiting instead of in the background')
     # chisel arguments
     parser.add_argument('--enable-log', action='store_true', help='enable log')
     parser.add_argument('--num-cores', type=int, help='number of cores')
@@ -500,12 +831,20 @@ if __name__ == "__main__":
     parser.add_argument('--threads', nargs='?', type=int, help='number of emu threads')
     parser.add_argument('--trace', action='store_true', help='enable waveform')
     parser.add_argument('--config', nargs='?', type=str, help='config')
+    parser.add_argument('--build-cache', nargs='?', type=str, const=DEFAULT_BUILD_CACHE_DIR,
+                        help='restore build outputs from this cache directory (default: ~/.cache/xiangshan/build)')
     # emu arguments
     parser.add_argument('--numa', action='store_true', help='use numactl')
     parser.add_argument('--diff', nargs='?', default="./ready-to-run/riscv64-nemu-interpreter-so", type=str, help='nemu so')
     parser.add_argument('--max-instr', nargs='?', type=int, help='max instr')
     parser.add_argument('--disable-fork', action='store_true', help='disable lightSSS')
     parser.add_argument('--no-diff', action='store_true', help='disable difftest')
+    parser.add_argument('--replay-failure', nargs='?', type=int, const=10000,
+                        help='get the waveform of the last N cycles of failed runs (default: 10000), '
+                             'simulates them again from cycle 0 if LightSSS dumped no waveform, '
+                             'which doubles their time, not meant for long CI workloads')
+    parser.add_argument('--speed-history', nargs='?', type=str, const=DEFAULT_SPEED_HISTORY,
+                        help='append simulation speed of emu runs to this file (default: ~/.cache/xiangshan/emu-speed.jsonl)')
 
     args = parser.parse_args()
 